@@ -7,25 +7,35 @@ Parset PDF/TXT bestanden en indexeert ze in Memgraph met embeddings
 import os
 import sys
 import json
+import mmap
+from contextlib import ExitStack
 from pathlib import Path
 from typing import List, Dict, Tuple
 import re
 
+MMAP_MIN_BYTES = 1024 * 1024  # PDFs larger than this are read via mmap
+
 def parse_pdf(file_path: str) -> List[str]:
     """Parse PDF file into text chunks"""
     try:
         from PyPDF2 import PdfReader
 
         chunks = []
-        reader = PdfReader(file_path)
-
-        for page_num, page in enumerate(reader.pages):
-            text = page.extract_text()
-            # Split by paragraphs
-            paragraphs = text.split('\n\n')
-            for para in paragraphs:
-                if para.strip() and len(para.strip()) > 50:  # Only keep substantial chunks
-                    chunks.append(para.strip())
+        with open(file_path, 'rb') as f, ExitStack() as stack:
+            # PdfReader(path) copies the whole file into a BytesIO; for large
+            # PDFs read straight from the page cache through a read-only mmap
+            stream = f
+            if os.fstat(f.fileno()).st_size > MMAP_MIN_BYTES:
+                stream = stack.enter_context(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+            reader = PdfReader(stream)
+
+            for page_num, page in enumerate(reader.pages):
+                text = page.extract_text()
+                # Split by paragraphs
+                paragraphs = text.split('\n\n')
+                for para in paragraphs:
+                    if para.strip() and len(para.strip()) > 50:  # Only keep substantial chunks
+                        chunks.append(para.strip())
 
         return chunks
     except Exception as e:
@@ -76,16 +86,27 @@ def extract_article_number(text: str) -> str:
 
     return "UNKNOWN"
 
-def generate_embeddings(chunks: List[str]) -> List[Dict]:
-    """Generate embeddings for text chunks (batch processing optimized for 16GB RAM)"""
+def load_embedding_model():
+    """Load the embedding model (~2 GB); raises ImportError without sentence_transformers"""
+    from sentence_transformers import SentenceTransformer
+    print("   ⏳ Loading embedding model...")
+    return SentenceTransformer('intfloat/multilingual-e5-large')
+
+def generate_embeddings(chunks: List[str], model=None) -> List[Dict]:
+    """Generate embeddings for text chunks (batch processing optimized for 16GB RAM)
+
+    model: from load_embedding_model(), for callers that embed many batches
+    (the batch importer). Without it the model is loaded for this call only
+    and freed afterwards, so it doesn't stay resident in a web worker.
+    """
     result = []
     batch_size = 64  # Optimized for 16GB RAM server - 8x faster than conservative 8-batch size
 
     try:
-        from sentence_transformers import SentenceTransformer
+        import numpy as np
         import gc
-        print("   ⏳ Loading embedding model...")
-        model = SentenceTransformer('intfloat/multilingual-e5-large')
+        if model is None:
+            model = load_embedding_model()
 
         # Process in batches to avoid loading all embeddings in memory at once
         total_chunks = len(chunks)
@@ -93,15 +114,19 @@ def generate_embeddings(chunks: List[str]) -> List[Dict]:
             batch_end = min(batch_start + batch_size, total_chunks)
             batch_chunks = chunks[batch_start:batch_end]
 
-            # Encode this batch
-            embeddings = model.encode(batch_chunks, show_progress_bar=False)
+            # Encode this batch; keep it as one contiguous float16 matrix
+            # (half of float32, a fraction of a list of Python floats)
+            embeddings = np.asarray(
+                model.encode(batch_chunks, show_progress_bar=False),
+                dtype=np.float16
+            )
 
-            # Add to results
+            # Add to results - each 'embedding' is a row view into the matrix
             for chunk, embedding in zip(batch_chunks, embeddings):
                 result.append({
                     'text': chunk,
                     'article_number': extract_article_number(chunk),
-                    'embedding': embedding.tolist()
+                    'embedding': embedding
                 })
 
             # Clean up memory after each batch
@@ -155,20 +180,27 @@ def generate_embeddings(chunks: List[str]) -> List[Dict]:
         print(f"   ✅ Created {len(result)} articles with placeholder embeddings")
         return result
 
-def import_to_memgraph(memgraph, cao_name: str, embeddings_data: List[Dict]) -> int:
-    """Import chunks with embeddings into Memgraph"""
+def import_to_memgraph(memgraph, cao_name: str, embeddings_data: List[Dict],
+                       start_index: int = 0, create_cao: bool = True) -> int:
+    """Import chunks with embeddings into Memgraph
+
+    Can be called once per embedding batch: pass the running chunk offset as
+    start_index so article numbers stay unique, and create_cao=False after the
+    first batch.
+    """
     imported_count = 0
 
     # Create CAO node if not exists
-    try:
-        list(memgraph.execute_and_fetch(f"""
-            MERGE (cao:CAO {{name: '{cao_name}', version: '2025', source: 'local'}})
-        """))
-    except Exception as e:
-        print(f"   ⚠️  Error creating CAO node: {e}")
+    if create_cao:
+        try:
+            list(memgraph.execute_and_fetch(f"""
+                MERGE (cao:CAO {{name: '{cao_name}', version: '2025', source: 'local'}})
+            """))
+        except Exception as e:
+            print(f"   ⚠️  Error creating CAO node: {e}")
 
     # Import articles
-    for idx, data in enumerate(embeddings_data):
+    for idx, data in enumerate(embeddings_data, start_index):
         try:
             text_safe = data['text'].replace("'", "\\'").replace('"', '\\"')[:1000]  # Truncate
 
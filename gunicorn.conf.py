@@ -118,10 +118,27 @@ def on_starting(server):
     print(f"Bind: {bind}")
     print("=" * 80)
 
+def when_ready(server):
+    """Called in the master once the (preloaded) app is loaded, before forking"""
+    # Move everything the preloaded app allocated (stripe, boto3, services,
+    # models) into the permanent GC generation. Workers' collections then no
+    # longer write to those objects, so the pages stay shared copy-on-write.
+    import gc
+    gc.freeze()
+
 def on_reload(server):
     """Called when a worker is reloaded"""
     print("🔄 Worker reloaded")
 
+def post_fork(server, worker):
+    """Called in each worker right after fork"""
+    # preload_app=True: init_db() ran in the master, so the SQLAlchemy pool may
+    # hold connections opened before the fork. Drop them (without closing the
+    # master's sockets) so every worker opens its own connections.
+    from main import app, db
+    with app.app_context():
+        db.engine.dispose(close=False)
+
 def worker_exit(server, worker):
     """Called when a worker exits"""
     print(f"👷 Worker {worker.pid} exited")
@@ -136,6 +153,8 @@ def worker_exit(server, worker):
 # 3. Workers inherit the initialized service (efficient resource usage)
 # 4. The __del__ method in services.py ensures clean Memgraph connection shutdown
 # 5. graceful_timeout gives workers time to close Memgraph connections properly
+# 6. Each worker has its own SQLAlchemy pool: keep
+#    workers * (DB_POOL_SIZE + DB_MAX_OVERFLOW) below PostgreSQL max_connections
 
 # ==============================================================================
 # DEPLOYMENT INSTRUCTIONS
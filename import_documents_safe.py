@@ -16,26 +16,44 @@ import gc
 import psutil
 import json
 import time
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, Future
 from pathlib import Path
-from typing import List, Dict
+from typing import Optional
 from datetime import datetime
 
 sys.path.insert(0, '/var/www/lexi')
 
 from gqlalchemy import Memgraph
-from document_importer import parse_document, generate_embeddings, import_to_memgraph
+from document_importer import parse_document, generate_embeddings, import_to_memgraph, load_embedding_model
 
 class SafeDocumentImporter:
     def __init__(self, memgraph_host='localhost', memgraph_port=7687):
         self.memgraph = Memgraph(host=memgraph_host, port=memgraph_port)
-        self.import_state_file = '/tmp/import_state.json'
+        self.import_state_file = '/tmp/import_state.json'  # Legacy, migrated on load
+        self.state_logs = {
+            'imported_files': '/tmp/import_state.imported.log',
+            'failed_files': '/tmp/import_state.failed.log',
+        }
         self.max_memory_mb = 3000  # Max RAM to use for embeddings
         self.batch_size_chunks = 32  # Chunks to process at once
+        self.parse_workers = min(4, os.cpu_count() or 1)  # Parallel PDF/TXT parsers
         self.log_file = '/var/log/lexi/document_import.log'
+        self._memory_reading = None  # (monotonic ts, used MB, percent)
+        self._embedding_model = None  # Loaded once per run, shared by all batches
 
         Path(self.log_file).parent.mkdir(parents=True, exist_ok=True)
         self.load_import_state()
 
+    def get_embedding_model(self):
+        """Embedding model for all batches of this run (None: generate_embeddings falls back to placeholders)"""
+        if self._embedding_model is None:
+            try:
+                self._embedding_model = load_embedding_model()
+            except Exception as e:
+                self.log(f"   ⚠️  Embedding model not available: {str(e)[:100]}")
+        return self._embedding_model
+
     def log(self, message: str):
         """Log import progress"""
         timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
@@ -49,39 +67,71 @@ class SafeDocumentImporter:
             pass
 
     def load_import_state(self):
-        """Load previously imported documents"""
+        """Load previously imported documents (one file name per log line)"""
+        self.state = {key: set() for key in self.state_logs}
+
+        # Migrate legacy JSON state file from older runs
         try:
             if Path(self.import_state_file).exists():
                 with open(self.import_state_file, 'r') as f:
-                    self.state = json.load(f)
-            else:
-                self.state = {'imported_files': [], 'failed_files': []}
-        except:
-            self.state = {'imported_files': [], 'failed_files': []}
-
-    def save_import_state(self):
-        """Save import progress"""
+                    legacy = json.load(f)
+                for key in self.state_logs:
+                    for file_name in legacy.get(key, []):
+                        if file_name not in self.state[key]:
+                            self.record_import_state(key, file_name)
+                os.remove(self.import_state_file)
+        except Exception as e:
+            self.log(f"⚠️  Error migrating legacy state: {e}")
+
+        for key, log_path in self.state_logs.items():
+            try:
+                if Path(log_path).exists():
+                    with open(log_path, 'r') as f:
+                        self.state[key].update(line for line in f.read().splitlines() if line)
+            except Exception as e:
+                self.log(f"⚠️  Error loading state {log_path}: {e}")
+
+    def record_import_state(self, key: str, file_name: str):
+        """Append one file to the imported/failed log - O(1) per file"""
+        self.state[key].add(file_name)
         try:
-            with open(self.import_state_file, 'w') as f:
-                json.dump(self.state, f)
+            with open(self.state_logs[key], 'a') as f:
+                f.write(file_name + '\n')
         except Exception as e:
             self.log(f"⚠️  Error saving state: {e}")
 
-    def check_memory(self):
-        """Check current memory usage"""
+    def reset_import_state(self):
+        """Forget all imported/failed files"""
+        self.state = {key: set() for key in self.state_logs}
+        for log_path in list(self.state_logs.values()) + [self.import_state_file]:
+            try:
+                Path(log_path).unlink(missing_ok=True)
+            except Exception as e:
+                self.log(f"⚠️  Error resetting state {log_path}: {e}")
+
+    def check_memory(self, max_age: float = 1.0):
+        """Check current memory usage (reading cached for max_age seconds)"""
+        now = time.monotonic()
+        if self._memory_reading and now - self._memory_reading[0] < max_age:
+            return self._memory_reading[1], self._memory_reading[2]
+
         memory = psutil.virtual_memory()
         memory_mb = memory.used // (1024*1024)
+        self._memory_reading = (now, memory_mb, memory.percent)
         return memory_mb, memory.percent
 
     def cleanup_memory(self):
-        """Force memory cleanup"""
+        """Force memory cleanup (gc.collect is synchronous, no need to wait)"""
         gc.collect()
-        time.sleep(0.5)
-        mem_mb, mem_pct = self.check_memory()
+        mem_mb, mem_pct = self.check_memory(max_age=0)
         self.log(f"   Cleaned memory: {mem_mb}MB ({mem_pct:.1f}%)")
 
-    def import_document(self, file_path: str) -> bool:
-        """Import single document safely"""
+    def import_document(self, file_path: str, parse_future: Optional[Future] = None) -> bool:
+        """Import single document safely
+
+        parse_future: optional pending parse_document() result from the
+        directory pipeline; parsed inline when not given.
+        """
         file_path = Path(file_path)
         file_name = file_path.name
 
@@ -97,13 +147,15 @@ class SafeDocumentImporter:
         try:
             self.log(f"\n📄 Processing: {file_name}")
 
-            # Parse document
-            cao_name, chunks = parse_document(str(file_path))
+            # Parse document (or pick up the result parsed ahead in a worker)
+            if parse_future is not None:
+                cao_name, chunks = parse_future.result()
+            else:
+                cao_name, chunks = parse_document(str(file_path))
 
             if not chunks:
                 self.log(f"   ⚠️  No chunks extracted")
-                self.state['failed_files'].append(file_name)
-                self.save_import_state()
+                self.record_import_state('failed_files', file_name)
                 return False
 
             self.log(f"   ✓ Parsed: {len(chunks)} chunks")
@@ -114,25 +166,30 @@ class SafeDocumentImporter:
                 self.log(f"   🔴 HIGH MEMORY ({mem_pct:.1f}%) - Cleaning...")
                 self.cleanup_memory()
 
-            # Generate embeddings with batch size
-            self.log(f"   ⏳ Generating embeddings (batch size: {self.batch_size_chunks})...")
+            # Generate embeddings per batch and push each batch to Memgraph
+            # immediately, so peak memory stays at one batch instead of the
+            # whole document
+            self.log(f"   ⏳ Generating embeddings + importing (batch size: {self.batch_size_chunks})...")
 
-            embeddings_data = []
+            imported_count = 0
             for batch_start in range(0, len(chunks), self.batch_size_chunks):
                 batch_end = min(batch_start + self.batch_size_chunks, len(chunks))
                 batch_chunks = chunks[batch_start:batch_end]
 
-                # Generate for this batch
+                # Generate + import this batch
                 try:
-                    batch_embeddings = generate_embeddings(batch_chunks)
-                    embeddings_data.extend(batch_embeddings)
+                    batch_embeddings = generate_embeddings(batch_chunks, model=self.get_embedding_model())
+                    imported_count += import_to_memgraph(
+                        self.memgraph, cao_name, batch_embeddings,
+                        start_index=batch_start, create_cao=(batch_start == 0)
+                    )
 
                     # Cleanup after batch
                     del batch_embeddings
                     gc.collect()
 
                     progress = min(batch_end, len(chunks))
-                    self.log(f"      {progress}/{len(chunks)} chunks embedded...")
+                    self.log(f"      {progress}/{len(chunks)} chunks embedded + imported...")
 
                     # Check memory
                     mem_mb, mem_pct = self.check_memory()
@@ -142,38 +199,28 @@ class SafeDocumentImporter:
 
                 except Exception as e:
                     self.log(f"      ❌ Error in batch {batch_start}-{batch_end}: {e}")
-                    self.state['failed_files'].append(file_name)
-                    self.save_import_state()
+                    self.log(f"      ({imported_count} articles of earlier batches already in Memgraph)")
+                    self.record_import_state('failed_files', file_name)
                     return False
 
-            self.log(f"   ✓ Embeddings complete: {len(embeddings_data)} embeddings")
-
-            # Import to Memgraph
-            self.log(f"   ⏳ Importing to Memgraph...")
-            imported_count = import_to_memgraph(self.memgraph, cao_name, embeddings_data)
-
             if imported_count > 0:
                 self.log(f"   ✅ Imported {imported_count} articles")
-                self.state['imported_files'].append(file_name)
-                self.save_import_state()
+                self.record_import_state('imported_files', file_name)
 
                 # Final cleanup
-                del embeddings_data
                 gc.collect()
 
                 return True
             else:
                 self.log(f"   ⚠️  No articles imported")
-                self.state['failed_files'].append(file_name)
-                self.save_import_state()
+                self.record_import_state('failed_files', file_name)
                 return False
 
         except Exception as e:
             self.log(f"   ❌ Error: {e}")
             import traceback
             traceback.print_exc()
-            self.state['failed_files'].append(file_name)
-            self.save_import_state()
+            self.record_import_state('failed_files', file_name)
             return False
 
     def import_directory(self, directory: str):
@@ -184,7 +231,13 @@ class SafeDocumentImporter:
             self.log(f"❌ Directory not found: {doc_dir}")
             return
 
-        files = sorted(list(doc_dir.glob("**/*.pdf")) + list(doc_dir.glob("**/*.txt")))
+        # Single directory walk for both formats (instead of one glob per suffix)
+        files = sorted(
+            Path(root) / name
+            for root, _, names in os.walk(doc_dir)
+            for name in names
+            if name.lower().endswith(('.pdf', '.txt'))
+        )
 
         self.log(f"📁 Found {len(files)} files to process")
         self.log(f"   Already imported: {len(self.state['imported_files'])}")
@@ -197,17 +250,32 @@ class SafeDocumentImporter:
         failed = 0
         start_time = time.time()
 
-        for idx, file_path in enumerate(remaining, 1):
-            self.log(f"\n[{idx}/{len(remaining)}]")
-
-            if self.import_document(str(file_path)):
-                success += 1
-            else:
-                failed += 1
-
-            # Memory cleanup every 5 documents
-            if idx % 5 == 0:
-                self.cleanup_memory()
+        # Pipeline: parsing (CPU-bound) runs ahead for the next files in worker
+        # processes while this process embeds + imports the current file.
+        # At most parse_workers files are parsed ahead to bound memory.
+        # 'spawn' so workers never fork a process holding the embedding model.
+        with ProcessPoolExecutor(max_workers=self.parse_workers,
+                                 mp_context=multiprocessing.get_context('spawn')) as pool:
+            parsing = {}
+
+            for idx, file_path in enumerate(remaining, 1):
+                for ahead in range(idx, min(idx + self.parse_workers, len(remaining)) + 1):
+                    ahead_path = remaining[ahead - 1]
+                    if ahead not in parsing and ahead_path.name not in self.state['failed_files']:
+                        parsing[ahead] = pool.submit(parse_document, str(ahead_path))
+
+                self.log(f"\n[{idx}/{len(remaining)}]")
+
+                # imported_files is only updated after the Memgraph import
+                # succeeded, so an interrupted run resumes where it stopped
+                if self.import_document(str(file_path), parse_future=parsing.pop(idx, None)):
+                    success += 1
+                else:
+                    failed += 1
+
+                # Memory cleanup every 5 documents
+                if idx % 5 == 0:
+                    self.cleanup_memory()
 
         elapsed = time.time() - start_time
         self.log(f"\n\n{'='*60}")
@@ -230,8 +298,7 @@ def main():
     importer = SafeDocumentImporter()
 
     if args.reset:
-        importer.state = {'imported_files': [], 'failed_files': []}
-        importer.save_import_state()
+        importer.reset_import_state()
         print("⚠️  Import state reset")
 
     importer.import_directory(args.directory)
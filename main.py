@@ -1,5 +1,6 @@
 import os
 import re
+import hashlib
 import tempfile
 import json
 from dotenv import load_dotenv
@@ -7,7 +8,8 @@ from dotenv import load_dotenv
 # Load environment variables from .env file FIRST
 load_dotenv()
 
-from flask import Flask, render_template, request, redirect, url_for, jsonify, g, session, flash, Response
+from flask import Flask, render_template, request, redirect, url_for, jsonify, g, session, flash, Response, stream_with_context
+from flask.json.provider import DefaultJSONProvider
 from flask_login import LoginManager, login_user, logout_user, login_required, current_user
 from flask_wtf.csrf import CSRFProtect
 from flask_limiter import Limiter
@@ -15,21 +17,39 @@ from flask_limiter.util import get_remote_address
 from flask_compress import Compress
 from werkzeug.middleware.proxy_fix import ProxyFix
 from werkzeug.utils import secure_filename
-from models import db, SuperAdmin, Tenant, User, Chat, Message, Subscription, Template, UploadedFile, Artifact, SupportTicket, SupportReply
-from services import rag_service, s3_service, email_service, StripeService
+from sqlalchemy import tuple_
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import raiseload, load_only, joinedload
+from models import db, SuperAdmin, Tenant, User, Chat, Message, Subscription, Template, UploadedFile, Artifact, SupportTicket, SupportReply, ProcessedStripeEvent
+from services import rag_service, s3_service, email_service, cache_service, StripeService
+from stripe_config import get_price_id
+from model_cache import get_tenant_by_id, get_tenant_by_subdomain, get_user_by_id, TENANT_STATS_KEY
 import stripe
 from datetime import datetime, timedelta
 import secrets
-from functools import wraps
+from concurrent.futures import ThreadPoolExecutor
+from functools import wraps, lru_cache
+from urllib.parse import urlparse
+from collections import defaultdict
+from bisect import bisect_left, bisect_right
+from itertools import accumulate
 
 # Optional imports - may not be available in all environments
 try:
-    from markitdown import MarkItDown
-    MARKITDOWN_AVAILABLE = True
-except (ImportError, AttributeError) as e:
-    print(f"⚠️  MarkItDown not available: {e}")
-    MarkItDown = None
-    MARKITDOWN_AVAILABLE = False
+    from flask_session import Session
+    FLASK_SESSION_AVAILABLE = True
+except ImportError as e:
+    print(f"⚠️  Flask-Session not available, using cookie sessions: {e}")
+    Session = None
+    FLASK_SESSION_AVAILABLE = False
+
+try:
+    import orjson
+    ORJSON_AVAILABLE = True
+except ImportError as e:
+    print(f"⚠️  orjson not available, using stdlib json: {e}")
+    orjson = None
+    ORJSON_AVAILABLE = False
 
 try:
     import pytesseract
@@ -43,6 +63,36 @@ except (ImportError, AttributeError) as e:
 
 app = Flask(__name__)
 app.wsgi_app = ProxyFix(app.wsgi_app, x_proto=1, x_host=1)
+# Zelfde LOG_LEVEL als gunicorn; debug-logging van de request paden staat dan standaard uit
+app.logger.setLevel(os.environ.get('LOG_LEVEL', 'info').upper())
+
+if ORJSON_AVAILABLE:
+    class OrjsonProvider(DefaultJSONProvider):
+        """jsonify() and request.json via orjson.
+
+        datetime/date and other types orjson doesn't handle natively go through
+        Flask's default() so the output format stays the same as stdlib json.
+        """
+        options = orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME
+
+        def dumps(self, obj, **kwargs):
+            return orjson.dumps(obj, default=self.default, option=self.options).decode('utf-8')
+
+        def loads(self, s, **kwargs):
+            if kwargs:
+                # bv. object_hook van de session serializer (TaggedJSONSerializer)
+                return super().loads(s, **kwargs)
+            return orjson.loads(s)
+
+        def response(self, *args, **kwargs):
+            # Write the bytes straight into the response, no str round-trip
+            obj = self._prepare_response_obj(args, kwargs)
+            return self._app.response_class(
+                orjson.dumps(obj, default=self.default, option=self.options | orjson.OPT_APPEND_NEWLINE),
+                mimetype=self.mimetype
+            )
+
+    app.json = OrjsonProvider(app)
 
 # SECURITY: Enable Jinja2 autoescape to prevent XSS attacks
 app.jinja_env.autoescape = True
@@ -63,6 +113,12 @@ super_admin_upload_status = {
 # Force new version after Vertex AI rate limit fixes (2025-10-24)
 BUILD_VERSION = os.environ.get('BUILD_VERSION', '20251024134500')
 
+# Chats per page in the chat sidebar (older chats are loaded on demand)
+CHAT_PAGE_SIZE = 50
+
+# Artifact blocks in AI responses: ```artifact:<type> title:<title>\n<content>```
+ARTIFACT_RE = re.compile(r'```artifact:(\w+)\s+title:([^\n]+)\n(.*?)```', re.DOTALL)
+
 # SECURITY: REQUIRE session secret - NEVER use hardcoded fallback (prevents session forgery)
 app.secret_key = os.environ.get("SESSION_SECRET") or os.environ.get("SECRET_KEY")
 if not app.secret_key:
@@ -76,7 +132,33 @@ app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
     "pool_recycle": 300,
     "pool_pre_ping": True,
 }
+# Connection pool per gunicorn worker (PostgreSQL; sqlite gebruikt geen QueuePool).
+# LIFO houdt dezelfde paar connecties warm zodat idle connecties door pool_recycle
+# opgeruimd worden in plaats van rouleren. Overschrijfbaar via env.
+# LET OP: workers * (DB_POOL_SIZE + DB_MAX_OVERFLOW) moet onder Postgres max_connections blijven.
+# statement_timeout begrenst runaway queries zodat ze geen connecties/locks vasthouden.
+if (app.config["SQLALCHEMY_DATABASE_URI"] or '').startswith('postgres'):
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"].update({
+        "pool_size": int(os.getenv('DB_POOL_SIZE', 10)),
+        "max_overflow": int(os.getenv('DB_MAX_OVERFLOW', 10)),
+        # Fail fast with a 500 instead of the 30s default wait when the pool is exhausted
+        "pool_timeout": int(os.getenv('DB_POOL_TIMEOUT', 10)),
+        "pool_use_lifo": True,
+        "connect_args": {
+            "options": f"-c statement_timeout={int(os.getenv('DB_STATEMENT_TIMEOUT_MS', 15000))}"
+        },
+    })
 app.config['MAX_CONTENT_LENGTH'] = 50 * 1024 * 1024
+# Browser uploads go straight to S3 (presigned PUT), so CSP connect-src must allow
+# the endpoint, both path-style and virtual-hosted bucket URLs
+if s3_service.enabled:
+    _s3_endpoint = urlparse(s3_service.endpoint)
+    S3_CONNECT_SRC = f" {_s3_endpoint.scheme}://{_s3_endpoint.netloc} {_s3_endpoint.scheme}://*.{_s3_endpoint.netloc}"
+else:
+    S3_CONNECT_SRC = ""
+
+# Chat endpoints (/api/chat/...) only take JSON messages; uploads go via /api/upload
+CHAT_API_MAX_BODY = 256 * 1024
 
 # CSRF Protection - ENABLED by default for security (disable only in dev with ENABLE_CSRF=false)
 app.config['WTF_CSRF_ENABLED'] = os.getenv('ENABLE_CSRF', 'true').lower() == 'true'
@@ -94,6 +176,16 @@ app.config['SESSION_COOKIE_HTTPONLY'] = True  # Prevent JavaScript access
 app.config['SESSION_COOKIE_DOMAIN'] = None
 app.config['PERMANENT_SESSION_LIFETIME'] = timedelta(hours=8)  # 8 hour session timeout
 
+# Server-side sessions in Redis (alleen als REDIS_URL gezet is): de cookie bevat dan
+# alleen een session id i.p.v. de hele geserialiseerde + gesigneerde payload
+if FLASK_SESSION_AVAILABLE and cache_service.redis is not None:
+    app.config['SESSION_TYPE'] = 'redis'
+    app.config['SESSION_REDIS'] = cache_service.redis
+    app.config['SESSION_KEY_PREFIX'] = 'lexi:session:'
+    app.config['SESSION_PERMANENT'] = False  # zelfde gedrag als cookie sessions; session.permanent blijft werken
+    Session(app)
+    print("Server-side sessions enabled (Redis)")
+
 if app.config['WTF_CSRF_ENABLED']:
     csrf = CSRFProtect(app)
     print("CSRF Protection enabled")
@@ -145,11 +237,20 @@ login_manager.login_view = 'login'
 
 @login_manager.user_loader
 def load_user(user_id):
-    # Try to load as SuperAdmin first, then fall back to regular User
-    super_admin = SuperAdmin.query.get(int(user_id))
+    # Eén query per request: SuperAdmin.get_id() geeft 'sa:<id>', en de login
+    # routes zetten session['is_super_admin'], dus we weten welke tabel het is
+    if user_id.startswith('sa:'):
+        return db.session.get(SuperAdmin, int(user_id[3:]))
+    is_super_admin = session.get('is_super_admin')
+    if is_super_admin is True:
+        return db.session.get(SuperAdmin, int(user_id))
+    if is_super_admin is False:
+        return get_user_by_id(int(user_id))
+    # Legacy sessie/remember cookie zonder vlag: oude volgorde (SuperAdmin eerst)
+    super_admin = db.session.get(SuperAdmin, int(user_id))
     if super_admin:
         return super_admin
-    return User.query.get(int(user_id))
+    return get_user_by_id(int(user_id))
 
 @login_manager.unauthorized_handler
 def unauthorized():
@@ -160,14 +261,36 @@ def unauthorized():
     # Otherwise redirect to normal login
     return redirect(url_for('login', next=request.path))
 
+TIER_MAX_USERS = {
+    'starter': 5,
+    'professional': 10,
+    'enterprise': 999999
+}
+
 def get_max_users_for_tier(tier):
     """Get max users allowed for a subscription tier"""
-    tier_limits = {
-        'starter': 5,
-        'professional': 10,
-        'enterprise': 999999
-    }
-    return tier_limits.get(tier, 5)
+    return TIER_MAX_USERS.get(tier, 5)
+
+def reserve_user_seat(tenant_id):
+    """Claim a user seat for the tenant in one UPDATE; False when max_users is reached.
+
+    The row lock taken by the UPDATE is held until commit, so concurrent adds
+    cannot both pass the limit check (unlike COUNT(*) followed by INSERT).
+    """
+    return db.session.execute(
+        db.update(Tenant)
+        .where(Tenant.id == tenant_id, Tenant.user_count < Tenant.max_users)
+        .values(user_count=Tenant.user_count + 1)
+        .returning(Tenant.id)
+    ).first() is not None
+
+def release_user_seat(tenant_id):
+    """Give a user seat back after deleting a user"""
+    db.session.execute(
+        db.update(Tenant)
+        .where(Tenant.id == tenant_id, Tenant.user_count > 0)
+        .values(user_count=Tenant.user_count - 1)
+    )
 
 @app.before_request
 def force_https():
@@ -187,9 +310,24 @@ def force_https():
             url = request.url.replace('http://', 'https://', 1)
             return redirect(url, code=301)
 
+@app.before_request
+def limit_chat_api_body():
+    """Chat API bodies are small JSON; reject oversized ones before any DB work"""
+    if request.path.startswith('/api/chat/') and (request.content_length or 0) > CHAT_API_MAX_BODY:
+        return jsonify({'error': 'Bericht is te groot'}), 413
+
+# Requests without tenant context: assets, health checks, SEO files and the super admin area
+NON_TENANT_PATH_PREFIXES = ('/static/', '/favicon', '/health', '/robots.txt', '/sitemap.xml', '/super-admin/')
+
+def is_non_tenant_request():
+    return request.endpoint == 'static' or request.path.startswith(NON_TENANT_PATH_PREFIXES)
+
 @app.before_request
 def cleanup_stale_pending_signups():
     """Clean up pending signups older than 24 hours"""
+    if is_non_tenant_request():
+        return
+    
     from models import PendingSignup
     from datetime import datetime, timedelta
     
@@ -203,51 +341,50 @@ def cleanup_stale_pending_signups():
         db.session.commit()
         print(f"🧹 Cleaned up {count} stale pending signups")
 
+# Allowed hosts are fixed for the process: parse ALLOWED_HOSTS once instead of per request
+ALLOWED_HOSTS = frozenset(
+    h.strip() for h in os.getenv('ALLOWED_HOSTS', 'localhost,127.0.0.1,replit.dev,replit.app').split(',')
+)
+ALLOWED_HOST_SUFFIXES = tuple(f'.{h}' for h in ALLOWED_HOSTS)
+
 @app.before_request
 def validate_host_header():
     """SECURITY: Global Host header validation - prevents Host header injection attacks"""
     # SECURITY: Validate Host header against allowed domains (GLOBAL protection)
-    request_host = request.host.split(':')[0]  # Remove port
-
-    # Get allowed hosts from environment (default includes localhost + Replit domains)
-    allowed_hosts_env = os.getenv('ALLOWED_HOSTS', 'localhost,127.0.0.1,replit.dev,replit.app')
-    allowed_hosts = [h.strip() for h in allowed_hosts_env.split(',')]
+    request_host = request.host.partition(':')[0]  # Remove port
 
     # Check if host is allowed (exact match or subdomain of allowed domain)
-    is_allowed = request_host in allowed_hosts or any(
-        request_host.endswith(f'.{allowed}') or request_host == allowed
-        for allowed in allowed_hosts
-    )
-
-    if not is_allowed:
-        app.logger.warning(f"🚨 SECURITY: Rejected Host header: {request_host} | Allowed: {allowed_hosts}")
-        print(f"[DEBUG] validate_host_header: request_host={request_host}, allowed_hosts={allowed_hosts}, is_allowed={is_allowed}")
+    if request_host not in ALLOWED_HOSTS and not request_host.endswith(ALLOWED_HOST_SUFFIXES):
+        app.logger.warning(f"🚨 SECURITY: Rejected Host header: {request_host} | Allowed: {sorted(ALLOWED_HOSTS)}")
         return "Invalid Host header", 400
-    else:
-        print(f"[DEBUG] validate_host_header: request_host={request_host} is allowed")
 
 @app.before_request
 def load_tenant():
     """Load tenant from session after login - NO subdomain routing"""
     g.tenant = None
     g.is_super_admin = session.get('is_super_admin', False)
-    print(f"[DEBUG] load_tenant - session keys: {list(session.keys())}, is_super_admin: {g.is_super_admin}")
+    if is_non_tenant_request():
+        return
+    app.logger.debug("load_tenant - session keys: %s, is_super_admin: %s", list(session.keys()), g.is_super_admin)
 
     if g.is_super_admin:
         return
     
     # Multi-tenant via session (set after login)
     tenant_id = session.get('tenant_id')
-    print(f"[DEBUG] load_tenant - tenant_id from session: {tenant_id}")
+    app.logger.debug("load_tenant - tenant_id from session: %s", tenant_id)
     if tenant_id:
-        g.tenant = Tenant.query.get(tenant_id)
-        print(f"[DEBUG] Tenant loaded from session: {g.tenant.company_name if g.tenant else None}")
+        g.tenant = get_tenant_by_id(tenant_id)
+        app.logger.debug("Tenant loaded from session: %s", g.tenant.company_name if g.tenant else None)
+
+ACTIVE_SUBSCRIPTION_STATUSES = frozenset({'active', 'trial', 'trialing'})
 
 def tenant_required(f):
     @wraps(f)
     def decorated_function(*args, **kwargs):
         if not g.tenant:
             return "Tenant niet gevonden", 404
+        g.subscription_active = g.tenant.subscription_status in ACTIVE_SUBSCRIPTION_STATUSES
         return f(*args, **kwargs)
     return decorated_function
 
@@ -295,7 +432,7 @@ def add_security_and_cache_headers(response):
         "style-src 'self' 'unsafe-inline'; "
         "img-src 'self' data: https:; "
         "font-src 'self' data:; "
-        "connect-src 'self' https://api.stripe.com; "
+        f"connect-src 'self' https://api.stripe.com{S3_CONNECT_SRC}; "
         "frame-src 'self' https://js.stripe.com; "
         "form-action 'self'; "
         "base-uri 'self'; "
@@ -322,7 +459,7 @@ def add_security_and_cache_headers(response):
     # Cache static files for 1 year, no cache for dynamic pages
     if request.path.startswith('/static/'):
         response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
-    else:
+    elif 'Cache-Control' not in response.headers:
         response.headers['Cache-Control'] = 'no-cache, no-store, must-revalidate'
         response.headers['Pragma'] = 'no-cache'
         response.headers['Expires'] = '0'
@@ -343,20 +480,22 @@ def sitemap():
         {'loc': url_for('terms', _external=True), 'lastmod': '2025-01-18', 'changefreq': 'monthly', 'priority': '0.5'},
     ]
     
-    sitemap_xml = '<?xml version="1.0" encoding="UTF-8"?>\n'
-    sitemap_xml += '<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">\n'
+    parts = ['<?xml version="1.0" encoding="UTF-8"?>\n',
+             '<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">\n']
     
     for page in pages:
-        sitemap_xml += '  <url>\n'
-        sitemap_xml += f'    <loc>{page["loc"]}</loc>\n'
-        sitemap_xml += f'    <lastmod>{page["lastmod"]}</lastmod>\n'
-        sitemap_xml += f'    <changefreq>{page["changefreq"]}</changefreq>\n'
-        sitemap_xml += f'    <priority>{page["priority"]}</priority>\n'
-        sitemap_xml += '  </url>\n'
+        parts.append(
+            '  <url>\n'
+            f'    <loc>{page["loc"]}</loc>\n'
+            f'    <lastmod>{page["lastmod"]}</lastmod>\n'
+            f'    <changefreq>{page["changefreq"]}</changefreq>\n'
+            f'    <priority>{page["priority"]}</priority>\n'
+            '  </url>\n'
+        )
     
-    sitemap_xml += '</urlset>'
+    parts.append('</urlset>')
     
-    return Response(sitemap_xml, mimetype='application/xml')
+    return Response(''.join(parts), mimetype='application/xml')
 
 @app.route('/robots.txt')
 def robots():
@@ -371,13 +510,38 @@ Sitemap: {url_for('sitemap', _external=True)}
     
     return Response(robots_txt, mimetype='text/plain')
 
+# Gerenderde HTML van publieke pagina's per template (per proces, vervalt bij een nieuwe deploy)
+_public_page_cache = {}
+
+def render_public_page(template_name):
+    """Render a marketing page once and serve it with an ETag (304 on If-None-Match).
+
+    Anonymous visitors without flash messages all get the same HTML; the page is
+    rendered without the CSRF meta tag (landing/pricing post nothing), so the
+    cached body holds no per-session data.
+    """
+    if current_user.is_authenticated or session.get('_flashes'):
+        return render_template(template_name)
+    
+    cached = _public_page_cache.get(template_name)
+    if cached is None:
+        html = render_template(template_name, public_page=True)
+        etag = hashlib.sha1(f"{BUILD_VERSION}:{html}".encode()).hexdigest()
+        cached = _public_page_cache[template_name] = (html, etag)
+    
+    html, etag = cached
+    response = Response(html, mimetype='text/html')
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'  # altijd revalideren, maar via 304 zonder body
+    return response.make_conditional(request)
+
 @app.route('/')
 def index():
-    return render_template('landing.html')
+    return render_public_page('landing.html')
 
 @app.route('/prijzen')
 def pricing():
-    return render_template('pricing.html')
+    return render_public_page('pricing.html')
 
 @app.route('/algemene-voorwaarden')
 def terms():
@@ -392,30 +556,20 @@ def disclaimer():
     return render_template('disclaimer.html')
 
 def count_user_questions(user_id):
-    """Count total questions asked by user using message_count with fallbacks"""
-    user_chats = Chat.query.filter_by(user_id=user_id).all()
-    question_count = 0
-    
-    for c in user_chats:
-        if c.message_count and c.message_count > 0:
-            # Use message_count if available (most reliable)
-            # Divide by 2 since message_count includes both user and assistant messages
-            question_count += (c.message_count + 1) // 2
-        elif c.s3_messages_key:
-            # Try S3 if message_count not set
-            messages = s3_service.get_chat_messages(c.s3_messages_key)
-            if messages:
-                question_count += sum(1 for m in messages if m.get('role') == 'user')
-            else:
-                # S3 failed, try PostgreSQL
-                db_messages = Message.query.filter_by(chat_id=c.id, role='user').count()
-                question_count += db_messages
-        else:
-            # No S3, use PostgreSQL
-            db_messages = Message.query.filter_by(chat_id=c.id, role='user').count()
-            question_count += db_messages
+    """Count total questions asked by user in one aggregate query (no per-chat queries, no S3)"""
+    # Chats zonder message_count: user-berichten in PostgreSQL via een gecorreleerde
+    # COUNT op idx_messages_tenant_chat, alleen uitgevoerd voor die chats
+    legacy_questions = db.select(db.func.count(Message.id)).where(
+        Message.tenant_id == Chat.tenant_id,
+        Message.chat_id == Chat.id,
+        Message.role == 'user'
+    ).scalar_subquery()
     
-    return question_count
+    # message_count bevat user + assistant berichten, dus (n + 1) // 2 vragen per chat
+    return db.session.query(db.func.coalesce(db.func.sum(db.case(
+        (Chat.message_count > 0, (Chat.message_count + 1) // 2),
+        else_=legacy_questions
+    )), 0)).filter(Chat.user_id == user_id).scalar()
 
 @app.route('/signup/tenant', methods=['GET', 'POST'])
 def signup_tenant():
@@ -424,8 +578,6 @@ def signup_tenant():
     billing = request.args.get('billing', 'monthly')
     
     if request.method == 'POST':
-        from stripe_config import get_price_id
-        
         company_name = request.form.get('company_name') or ''
         contact_email = request.form.get('contact_email') or ''
         contact_name = request.form.get('contact_name') or ''
@@ -440,8 +592,10 @@ def signup_tenant():
             return render_template('signup_tenant.html', tier=tier, billing=billing)
         
         # Check if email already exists
-        existing_user = User.query.filter_by(email=contact_email).first()
-        if existing_user:
+        email_taken = db.session.query(
+            User.query.filter_by(email=contact_email).exists()
+        ).scalar()
+        if email_taken:
             flash('Dit email adres is al in gebruik.', 'danger')
             return render_template('signup_tenant.html', tier=tier, billing=billing)
         
@@ -566,9 +720,12 @@ def signup_success():
             # Check if webhook has processed and created the account
             # (pending record will be deleted by webhook after account creation)
             db.session.expire(pending)
-            pending = PendingSignup.query.filter_by(checkout_session_id=session_id).first()
+            still_pending = db.session.query(
+                PendingSignup.query.filter_by(checkout_session_id=session_id).exists()
+            ).scalar()
             
-            if not pending:
+            if not still_pending:
+                pending = None
                 # Pending deleted = webhook processed successfully
                 app.logger.info(f"Webhook processed signup for {email}")
                 break
@@ -645,6 +802,7 @@ def signup_success():
     # Login the verified user automatically
     login_user(new_user)
     session['tenant_id'] = new_user.tenant_id
+    session['is_super_admin'] = False
     session.permanent = True
     
     app.logger.info(f"✅ Auto-logged in verified user: {new_user.email} (tenant_id: {new_user.tenant_id})")
@@ -685,17 +843,17 @@ def login():
         email = request.form.get('email', '').lower().strip()
         password = request.form.get('password')
         
-        print(f"Login attempt - Email: {email}")
+        app.logger.debug("Login attempt - Email: %s", email)
         
         # Zoek user op basis van email (uniek over alle tenants)
-        user = User.query.filter_by(email=email).first()
-        print(f"User found: {user is not None}")
+        # Tenant in dezelfde SELECT (JOIN) i.p.v. een tweede query na de password check
+        user = User.query.options(joinedload(User.tenant)).filter_by(email=email).first()
+        app.logger.debug("User found: %s", user is not None)
         
         if user and user.check_password(password):
-            print("Password check passed")
+            app.logger.debug("Password check passed")
             
-            # Haal de tenant op van deze user
-            tenant = Tenant.query.get(user.tenant_id)
+            tenant = user.tenant
             
             if not user.is_active:
                 flash('Je account is gedeactiveerd.', 'danger')
@@ -712,21 +870,22 @@ def login():
                                      show_force_login=True, 
                                      email=email)
             
-            user.session_token = secrets.token_hex(32)
+            # 32 tekens urlsafe (192 bits); alleen in de DB nodig voor de
+            # single-device check hierboven, niet in de session cookie
+            user.session_token = secrets.token_urlsafe(24)
             db.session.commit()
             
             login_user(user)
             session['tenant_id'] = tenant.id  # Zet tenant_id automatisch in session
-            session['session_token'] = user.session_token
             session['is_super_admin'] = False
             
             if force_login:
                 flash('Oude sessie uitgelogd. Je bent nu ingelogd.', 'success')
             
-            print(f"Login successful - Tenant: {tenant.company_name}")
+            app.logger.debug("Login successful - Tenant: %s", tenant.company_name)
             return redirect(url_for('chat_page'))
         
-        print("Login failed - invalid credentials")
+        app.logger.debug("Login failed - invalid credentials")
         flash('Ongeldige email of wachtwoord.', 'danger')
     
     return render_template('login.html')
@@ -739,11 +898,11 @@ def forgot_password():
         email = request.form.get('email', '').lower().strip()
         
         # Find user by email
-        user = User.query.filter_by(email=email).first()
+        user = User.query.options(joinedload(User.tenant)).filter_by(email=email).first()
         
         if user:
-            # Get tenant for email context
-            tenant = Tenant.query.get(user.tenant_id)
+            # Tenant for email context, loaded in the same query as the user
+            tenant = user.tenant
             
             if tenant and user.is_active:
                 # Generate secure URL-safe reset token
@@ -829,19 +988,15 @@ def super_admin_login():
         email = request.form.get('email') or ''
         password = request.form.get('password') or ''
         
-        print(f"[DEBUG] Super Admin Login Attempt:")
-        print(f"  Email: '{email}'")
-        print(f"  User-Agent: {request.headers.get('User-Agent', 'Unknown')}")
-        print(f"  Password length: {len(password)}")
+        app.logger.debug("Super Admin Login Attempt - Email: %r, User-Agent: %s",
+                         email, request.headers.get('User-Agent', 'Unknown'))
 
         admin = SuperAdmin.query.filter_by(email=email).first()
-        print(f"  Admin found: {admin is not None}")
+        app.logger.debug("Admin found: %s", admin is not None)
         
         if admin:
-            print(f"  Admin email: '{admin.email}'")
-            print(f"  Admin ID: {admin.id}")
             password_valid = admin.check_password(password)
-            print(f"  Password valid: {password_valid}")
+            app.logger.debug("Admin ID: %s, password valid: %s", admin.id, password_valid)
             
             if password_valid:
                 # FIX: Clear old session and set fresh login session
@@ -858,9 +1013,8 @@ def super_admin_login():
                 # Explicitly mark as modified to ensure cookie is set
                 session.modified = True
 
-                print(f"  ✅ Login successful for {email}")
-                print(f"  Session after login - keys: {list(session.keys())}, permanent: {session.permanent}")
-                print(f"  Flask-Login authenticated: {current_user.is_authenticated}")
+                app.logger.debug("Super admin login successful for %s - session keys: %s, permanent: %s",
+                                 email, list(session.keys()), session.permanent)
 
                 # Create redirect response and set session cookies
                 response = redirect(url_for('super_admin_dashboard'))
@@ -871,9 +1025,9 @@ def super_admin_login():
 
                 return response
             else:
-                print(f"  ❌ Password INCORRECT for {email}")
+                app.logger.debug("Super admin password incorrect for %s", email)
         else:
-            print(f"  ❌ NO admin found with email: '{email}'")
+            app.logger.debug("No super admin found with email: %r", email)
 
         flash('Ongeldige credentials.', 'danger')
 
@@ -885,17 +1039,17 @@ def select_tenant():
     """Development/admin mode: manually select a tenant (alleen voor super admins)"""
     if request.method == 'POST':
         subdomain = request.form.get('subdomain')
-        print(f"[DEBUG] select_tenant - subdomain: {subdomain}")
-        tenant = Tenant.query.filter_by(subdomain=subdomain).first()
+        app.logger.debug("select_tenant - subdomain: %s", subdomain)
+        tenant = get_tenant_by_subdomain(subdomain)
         if tenant:
             session['tenant_id'] = tenant.id
             session.modified = True  # Force session save
-            print(f"[DEBUG] Tenant ID {tenant.id} saved to session")
+            app.logger.debug("Tenant ID %s saved to session", tenant.id)
             flash(f'Tenant geselecteerd: {tenant.company_name}', 'success')
             return redirect(url_for('login'))
         flash('Tenant niet gevonden', 'danger')
     
-    tenants = Tenant.query.all()
+    tenants = Tenant.query.with_entities(Tenant.subdomain, Tenant.company_name).all()
     return render_template('select_tenant.html', tenants=tenants)
 
 @app.route('/logout')
@@ -917,11 +1071,10 @@ def user_profile():
         new_email = request.form.get('email')
         
         if new_email != current_user.email:
-            existing = User.query.filter_by(
-                tenant_id=g.tenant.id,
-                email=new_email
-            ).first()
-            if existing:
+            email_taken = db.session.query(
+                User.query.filter_by(tenant_id=g.tenant.id, email=new_email).exists()
+            ).scalar()
+            if email_taken:
                 flash('Dit e-mailadres is al in gebruik!', 'error')
                 return redirect(url_for('user_profile'))
         
@@ -1057,32 +1210,32 @@ def gdpr_delete_account():
         # Get all user's chats
         chats = Chat.query.filter_by(tenant_id=tenant_id, user_id=user_id).all()
 
-        # Delete chat messages from S3
+        # Collect S3 keys of chat messages, uploaded files and artifacts
+        s3_keys = []
         for chat in chats:
-            if chat.s3_messages_key:
-                s3_service.delete_file(chat.s3_messages_key)
+            s3_keys.append(chat.s3_messages_key)
             db.session.delete(chat)
 
-        # Delete uploaded files from S3
         files = UploadedFile.query.filter_by(tenant_id=tenant_id, user_id=user_id).all()
         for file in files:
-            if file.s3_key:
-                s3_service.delete_file(file.s3_key)
+            s3_keys.append(file.s3_key)
             db.session.delete(file)
 
-        # Delete artifacts from S3
         artifacts = Artifact.query.filter_by(tenant_id=tenant_id, user_id=user_id).all()
         for artifact in artifacts:
-            if artifact.s3_key:
-                s3_service.delete_file(artifact.s3_key)
+            s3_keys.append(artifact.s3_key)
             db.session.delete(artifact)
 
+        # Delete them from S3 in batches of 1000 instead of one request per object
+        s3_service.delete_files(s3_keys)
+
         # Logout user
         logout_user()
         session.clear()
 
         # Delete user account
         db.session.delete(current_user)
+        release_user_seat(tenant_id)
         db.session.commit()
 
         app.logger.info(f"GDPR: User {user_id} account deleted")
@@ -1101,22 +1254,30 @@ def gdpr_delete_account():
 @login_required
 @tenant_required
 def chat_page():
-    if g.tenant.subscription_status not in ['active', 'trial', 'trialing']:
+    if not g.subscription_active:
         flash('Je account is niet actief. Neem contact op met je beheerder.', 'warning')
         return redirect(url_for('index'))
     
-    chats = Chat.query.filter_by(
+    # Sidebar heeft alleen id/title/updated_at nodig: load_only haalt alleen die kolommen op,
+    # raiseload voorkomt dat de template ongemerkt andere kolommen of Message-rijen laadt (N+1).
+    # Alleen de eerste pagina; oudere chats via /api/chats?before=... ("Meer laden")
+    chats = Chat.query.options(
+        load_only(Chat.id, Chat.title, Chat.updated_at, raiseload=True),
+        raiseload(Chat.messages)
+    ).filter_by(
         tenant_id=g.tenant.id,
         user_id=current_user.id
-    ).order_by(Chat.updated_at.desc()).all()
+    ).order_by(Chat.updated_at.desc(), Chat.id.desc()).limit(CHAT_PAGE_SIZE + 1).all()
+    has_more_chats = len(chats) > CHAT_PAGE_SIZE
     
-    return render_template('chat.html', chats=chats, tenant=g.tenant, user=current_user)
+    return render_template('chat.html', chats=chats[:CHAT_PAGE_SIZE], has_more_chats=has_more_chats,
+                           chat_page_size=CHAT_PAGE_SIZE, tenant=g.tenant, user=current_user)
 
 @app.route('/api/chat/new', methods=['POST'])
 @login_required
 @tenant_required
 def new_chat():
-    if g.tenant.subscription_status not in ['active', 'trial', 'trialing']:
+    if not g.subscription_active:
         return jsonify({'error': 'Subscription niet actief'}), 403
     
     chat = Chat(
@@ -1125,28 +1286,27 @@ def new_chat():
         title='Nieuwe chat'
     )
     db.session.add(chat)
-    db.session.commit()
+    db.session.flush()  # chat.id voor de UPDATE hieronder
     
-    # Associate any pending uploaded files (chat_id=NULL) with this new chat
-    pending_files = UploadedFile.query.filter_by(
+    # Associate any pending uploaded files (chat_id=NULL) with this new chat,
+    # in one UPDATE and one commit together with the chat itself
+    associated = UploadedFile.query.filter_by(
         tenant_id=g.tenant.id,
         user_id=current_user.id,
         chat_id=None
-    ).all()
+    ).update({'chat_id': chat.id}, synchronize_session=False)
     
-    if pending_files:
-        for uploaded_file in pending_files:
-            uploaded_file.chat_id = chat.id
-        db.session.commit()
-        print(f"[DEBUG] Associated {len(pending_files)} pending files with new chat {chat.id}")
+    response = {'id': chat.id, 'title': chat.title}  # voor de commit: geen refresh-SELECT nodig
+    db.session.commit()
+    app.logger.debug("Associated %s pending files with new chat %s", associated, response['id'])
     
-    return jsonify({'id': chat.id, 'title': chat.title})
+    return jsonify(response)
 
 @app.route('/api/chat/<int:chat_id>', methods=['GET'])
 @login_required
 @tenant_required
 def get_chat(chat_id):
-    if g.tenant.subscription_status not in ['active', 'trial', 'trialing']:
+    if not g.subscription_active:
         return jsonify({'error': 'Subscription niet actief'}), 403
     
     chat = Chat.query.filter_by(
@@ -1159,6 +1319,24 @@ def get_chat(chat_id):
     messages = []
     if chat.s3_messages_key:
         s3_messages = s3_service.get_chat_messages(chat.s3_messages_key)
+
+        # Alle artifacts van deze chat in één query, gegroepeerd per message_id
+        # (message_id = positie van het bericht in de S3 transcript)
+        # Alleen de kolommen voor de JSON: rijen i.p.v. ORM objecten (geen identity map)
+        artifacts_by_message = defaultdict(list)
+        artifact_rows = db.session.query(
+            Artifact.id, Artifact.message_id, Artifact.title, Artifact.artifact_type, Artifact.content
+        ).filter(
+            Artifact.chat_id == chat.id,
+            Artifact.tenant_id == g.tenant.id
+        ).order_by(Artifact.id)
+        for row in artifact_rows:
+            artifacts_by_message[row.message_id].append({
+                'id': row.id,
+                'title': row.title,
+                'type': row.artifact_type,
+                'content': row.content
+            })
         for idx, m in enumerate(s3_messages):
             msg_data = {
                 'id': idx + 1,
@@ -1173,71 +1351,72 @@ def get_chat(chat_id):
                 msg_data['attachments'] = m.get('attachments')
             
             if m.get('role') == 'assistant':
-                artifacts = Artifact.query.filter_by(message_id=idx + 1, chat_id=chat.id, tenant_id=g.tenant.id).all()
+                artifacts = artifacts_by_message.get(idx + 1)
                 if artifacts:
-                    msg_data['artifacts'] = [{
-                        'id': a.id,
-                        'title': a.title,
-                        'type': a.artifact_type,
-                        'content': a.content
-                    } for a in artifacts]
+                    msg_data['artifacts'] = artifacts
             
             messages.append(msg_data)
     
     return jsonify({'id': chat.id, 'title': chat.title, 'messages': messages})
 
-@app.route('/api/chat/<int:chat_id>/message', methods=['POST'])
-@login_required
-@tenant_required
-@limiter.limit("30 per minute")
-def send_message(chat_id):
-    if g.tenant.subscription_status not in ['active', 'trial', 'trialing']:
-        return jsonify({'error': 'Subscription niet actief'}), 403
+def _prepare_chat_turn(chat_id):
+    """
+    Build the user's message and the prompt for the AI (shared by
+    send_message and send_message_stream).
+
+    Returns (chat, user_msg_dict, ai_message, None), or
+    (None, None, None, response) when the request ends before the AI call.
+    """
+    if not g.subscription_active:
+        return None, None, None, (jsonify({'error': 'Subscription niet actief'}), 403)
     
-    print(f"[DEBUG] send_message called - chat_id: {chat_id}, user: {current_user.id}")
+    app.logger.debug("send_message called - chat_id: %s, user: %s", chat_id, current_user.id)
+    
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return None, None, None, (jsonify({'error': 'Ongeldig verzoek'}), 400)
+    user_message = data.get('message', '')
     
     chat = Chat.query.filter_by(
         id=chat_id,
         tenant_id=g.tenant.id,
         user_id=current_user.id
     ).first_or_404()
-    
-    data = request.json
-    user_message = data.get('message', '')
-    print(f"[DEBUG] User message: {user_message}")
+
+    # Eerste bericht? Via de message_count kolom, niet via de messages relatie
+    # (NULL bij legacy/gemigreerde chats telt als leeg)
+    is_first_message = not chat.message_count
 
     # Get uploaded files for this chat
-    print(f"[DEBUG] 1. Starting file query for chat_id={chat.id}, tenant={g.tenant.id}, user={current_user.id}")
+    app.logger.debug("1. Starting file query for chat_id=%s, tenant=%s, user=%s", chat.id, g.tenant.id, current_user.id)
     try:
         uploaded_files = UploadedFile.query.filter_by(
             chat_id=chat.id,
             tenant_id=g.tenant.id,
             user_id=current_user.id
         ).all()
-        print(f"[DEBUG] 2. Found {len(uploaded_files)} uploaded files")
+        app.logger.debug("2. Found %s uploaded files", len(uploaded_files))
     except Exception as e:
-        print(f"[DEBUG] ERROR in file query: {str(e)}")
-        import traceback
-        traceback.print_exc()
+        app.logger.exception("Error in file query: %s", e)
         raise
 
     # Create user message dict for S3 with file attachments
-    print(f"[DEBUG] 3. Creating user_msg_dict")
+    app.logger.debug("3. Creating user_msg_dict")
     user_msg_dict = {
         'role': 'user',
         'content': user_message,
         'created_at': datetime.utcnow().isoformat()
     }
-    print(f"[DEBUG] 4. user_msg_dict created successfully")
+    app.logger.debug("4. user_msg_dict created successfully")
 
     # Add file attachments to message ONLY for newly uploaded files
     # Files uploaded AFTER the last message should be shown as attachments
     # For subsequent messages, old files are still used for AI context but not shown as attachments
     if uploaded_files:
-        print(f"[DEBUG] 5. Processing {len(uploaded_files)} uploaded files for attachments")
+        app.logger.debug("5. Processing %s uploaded files for attachments", len(uploaded_files))
         # Get files uploaded after the last message (new uploads since last message)
         # Guard against None updated_at (legacy/migrated chats) - show all files if None
-        if chat.message_count > 0 and chat.updated_at is not None:
+        if not is_first_message and chat.updated_at is not None:
             newly_uploaded = [f for f in uploaded_files if f.created_at > chat.updated_at]
         else:
             newly_uploaded = uploaded_files
@@ -1248,227 +1427,324 @@ def send_message(chat_id):
                 'filename': f.original_filename,
                 'mime_type': f.mime_type
             } for f in newly_uploaded]
-            print(f"[DEBUG] 6. Added {len(newly_uploaded)} attachments to message")
-
-    # Append to S3
-    print(f"[DEBUG] 7. About to call S3 service append_chat_message")
-    print(f"[DEBUG]    - chat.s3_messages_key: {chat.s3_messages_key}")
-    print(f"[DEBUG]    - chat.id: {chat.id}")
-    print(f"[DEBUG]    - tenant_id: {g.tenant.id}")
-    print(f"[DEBUG]    - S3 service enabled: {s3_service.enabled}")
-    try:
-        s3_key = s3_service.append_chat_message(
-            chat.s3_messages_key,
-            chat.id,
-            g.tenant.id,
-            user_msg_dict
-        )
-        print(f"[DEBUG] 8. S3 service returned s3_key: {s3_key}")
-    except Exception as e:
-        print(f"[DEBUG] ERROR in S3 service call: {str(e)}")
-        import traceback
-        traceback.print_exc()
-        raise
-
-    if not s3_key:
-        print(f"[DEBUG] 9. S3 returned None/False - returning error to user")
-        return jsonify({'error': 'Kon bericht niet opslaan. Probeer het opnieuw.'}), 500
+            app.logger.debug("6. Added %s attachments to message", len(newly_uploaded))
 
-    print(f"[DEBUG] 10. Updating chat object in database")
-    chat.s3_messages_key = s3_key
-    chat.message_count = (chat.message_count or 0) + 1
-    print(f"[DEBUG]     - Updated message_count to: {chat.message_count}")
-
-    if chat.message_count <= 1:
+    if is_first_message:
         chat.title = user_message[:50] + ('...' if len(user_message) > 50 else '')
-        print(f"[DEBUG]     - Set chat title: {chat.title}")
+        app.logger.debug("    - Set chat title: %s", chat.title)
 
-    chat.updated_at = datetime.utcnow()
-    print(f"[DEBUG] 11. About to commit database changes...")
-    try:
-        db.session.commit()
-        print(f"[DEBUG] 12. Database commit successful!")
-    except Exception as e:
-        print(f"[DEBUG] ERROR in database commit: {str(e)}")
-        import traceback
-        traceback.print_exc()
-        db.session.rollback()
-        raise
+    # Het user-bericht gaat pas na het AI-antwoord naar S3, samen met het
+    # assistant-bericht in één GET+PUT (_finish_chat_turn). Eindigt de beurt
+    # zonder antwoord, dan slaat _store_user_message_only het alleen op.
 
-    print(f"[DEBUG] 13. Building ai_message for Vertex AI...")
+    app.logger.debug("13. Building ai_message for Vertex AI...")
     ai_message = user_message
     file_errors = []
     
     if uploaded_files:
+        def download_content(s3_key, mime_type, filename):
+            try:
+                return s3_service.download_file_content(s3_key, mime_type)
+            except Exception as e:
+                app.logger.debug("Exception in S3 download for %s: %s", filename, e)
+                return None, "Kon bestand niet lezen"
+
+        # PDFs with pre-extracted text come from the database; everything else
+        # (incl. legacy PDFs / failed extractions) is downloaded from S3 in parallel
+        to_download = [
+            (i, uploaded_file) for i, uploaded_file in enumerate(uploaded_files)
+            if not (uploaded_file.mime_type == 'application/pdf'
+                    and uploaded_file.extracted_text and uploaded_file.extracted_text.strip())
+        ]
+        downloads = {}
+        if to_download:
+            app.logger.debug("Downloading %s files from S3", len(to_download))
+            with ThreadPoolExecutor(max_workers=min(8, len(to_download))) as executor:
+                results = executor.map(
+                    lambda args: download_content(*args),
+                    [(uf.s3_key, uf.mime_type, uf.original_filename) for _, uf in to_download]
+                )
+                downloads = dict(zip((i for i, _ in to_download), results))
+
         file_contents = []
-        for uploaded_file in uploaded_files:
-            print(f"[DEBUG] Processing file: {uploaded_file.original_filename}, type: {uploaded_file.mime_type}")
-            # For PDF files, try extracted_text from database first
-            if uploaded_file.mime_type == 'application/pdf':
-                if uploaded_file.extracted_text and uploaded_file.extracted_text.strip():
-                    # Use pre-extracted text if available and not empty
-                    print(f"[DEBUG] Using extracted_text from database (length: {len(uploaded_file.extracted_text)})")
-                    content = uploaded_file.extracted_text
-                    file_contents.append(f"\n\n--- Bestand: {uploaded_file.original_filename} ---\n{content}\n--- Einde bestand ---\n")
-                else:
-                    # Fallback: try downloading from S3 for legacy PDFs or failed extractions
-                    print(f"[DEBUG] No extracted_text, trying S3 fallback for {uploaded_file.original_filename}")
-                    try:
-                        content, error = s3_service.download_file_content(uploaded_file.s3_key, uploaded_file.mime_type)
-                        if error:
-                            print(f"[DEBUG] S3 error: {error}")
-                            file_errors.append(f"{uploaded_file.original_filename}: {error}")
-                        elif content:
-                            print(f"[DEBUG] S3 fallback successful, content length: {len(content)}")
-                            file_contents.append(f"\n\n--- Bestand: {uploaded_file.original_filename} ---\n{content}\n--- Einde bestand ---\n")
-                        else:
-                            print(f"[DEBUG] S3 returned empty content")
-                    except Exception as e:
-                        print(f"[DEBUG] Exception in S3 fallback: {str(e)}")
-                        file_errors.append(f"{uploaded_file.original_filename}: Kon bestand niet lezen")
+        for i, uploaded_file in enumerate(uploaded_files):
+            app.logger.debug("Processing file: %s, type: %s", uploaded_file.original_filename, uploaded_file.mime_type)
+            if i in downloads:
+                content, error = downloads[i]
             else:
-                # For non-PDF files, download from S3
-                content, error = s3_service.download_file_content(uploaded_file.s3_key, uploaded_file.mime_type)
-                if error:
-                    file_errors.append(f"{uploaded_file.original_filename}: {error}")
-                elif content:
-                    file_contents.append(f"\n\n--- Bestand: {uploaded_file.original_filename} ---\n{content}\n--- Einde bestand ---\n")
+                app.logger.debug("Using extracted_text from database (length: %s)", len(uploaded_file.extracted_text))
+                content, error = uploaded_file.extracted_text, None
+
+            if error:
+                app.logger.debug("S3 error: %s", error)
+                file_errors.append(f"{uploaded_file.original_filename}: {error}")
+            elif content:
+                file_contents.append(f"\n\n--- Bestand: {uploaded_file.original_filename} ---\n{content}\n--- Einde bestand ---\n")
+            else:
+                app.logger.debug("S3 returned empty content")
         
         if file_contents:
             ai_message = f"{user_message}\n\n{''.join(file_contents)}"
-            print(f"[DEBUG] Including {len(file_contents)} uploaded files in context")
+            app.logger.debug("Including %s uploaded files in context", len(file_contents))
         
         if file_errors and not file_contents:
             error_msg = "\n".join(file_errors)
-            return jsonify({'response': f"⚠️ Kon geen bestanden lezen:\n{error_msg}\n\nProbeer andere bestanden.", 'has_errors': True})
+            _store_user_message_only(chat, user_msg_dict)
+            return None, None, None, jsonify({'response': f"⚠️ Kon geen bestanden lezen:\n{error_msg}\n\nProbeer andere bestanden.", 'has_errors': True})
 
-    print("[DEBUG] 14. About to call RAG service (Memgraph + DeepSeek)...")
-    print(f"[DEBUG]     - ai_message length: {len(ai_message)} chars")
-    print(f"[DEBUG]     - RAG service enabled: {rag_service.enabled}")
-    try:
-        from cao_config import get_system_instruction
-        print("[DEBUG] 15. Imported cao_config successfully")
-        cao_instruction = get_system_instruction(g.tenant)
-        print(f"[DEBUG] 16. Got system instruction (length: {len(cao_instruction)} chars)")
-        print(f"[DEBUG] 17. Calling rag_service.chat() (Memgraph + DeepSeek)...")
-        lex_response = rag_service.chat(ai_message, system_instruction=cao_instruction)
-        print(f"[DEBUG] 18. RAG service response received (length: {len(lex_response)} chars)")
-        print(f"[DEBUG]     - First 100 chars: {lex_response[:100]}...")
-    except Exception as e:
-        print(f"[DEBUG] ERROR in RAG service call: {str(e)}")
-        import traceback
-        traceback.print_exc()
-        raise
-    
+    return chat, user_msg_dict, ai_message, None
+
+# Threads voor het ophalen van het S3-transcript tijdens de AI-call
+# (worden pas bij de eerste submit gestart, dus niet al in de gunicorn master)
+_transcript_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix='transcript')
+
+def _prefetch_transcript(chat):
+    """Start the S3 GET of the chat transcript in the background (None for a new chat)
+
+    The result carries the ETag; append_chat_message re-reads the transcript
+    if it changed during the AI call. Net effect on the write path: one GET
+    replaced by one HEAD (no body), not a saved round-trip.
+    """
+    if not chat.s3_messages_key:
+        return None
+    return _transcript_executor.submit(s3_service.get_chat_messages_versioned, chat.s3_messages_key)
+
+# Artifact-kopieën naar S3 na de response; de inhoud staat al in de database
+_artifact_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix='artifact')
+
+def upload_artifact_to_s3(artifact_id, tenant_id, title, content):
+    """Upload an artifact's content to S3 and store the key on its row; returns the key or None"""
+    s3_key = s3_service.upload_content(
+        content=content,
+        filename=f"{title}.txt",
+        tenant_id=tenant_id,
+        folder='artifacts'
+    )
+    if not s3_key:
+        return None
+    updated = db.session.execute(
+        db.update(Artifact).where(Artifact.id == artifact_id, Artifact.s3_key.is_(None)).values(s3_key=s3_key)
+    ).rowcount
+    db.session.commit()
+    if not updated:
+        # Key already set by a concurrent upload, or artifact deleted: don't leave an orphan object behind
+        s3_service.delete_file(s3_key)
+        return db.session.scalar(db.select(Artifact.s3_key).where(Artifact.id == artifact_id))
+    return s3_key
+
+def _upload_artifacts_in_background(artifacts):
+    """Queue S3 uploads for freshly committed artifacts (worker threads need their own app context)"""
+    def upload(artifact_id, tenant_id, title, content):
+        with app.app_context():
+            try:
+                upload_artifact_to_s3(artifact_id, tenant_id, title, content)
+            except Exception as e:
+                app.logger.exception("Background artifact upload failed (artifact %s): %s", artifact_id, e)
+
+    for artifact in artifacts:
+        _artifact_executor.submit(upload, artifact.id, artifact.tenant_id, artifact.title, artifact.content)
+
+def _store_user_message_only(chat, user_msg_dict):
+    """Turn ended without an AI response: still keep the user's message in S3 and commit"""
+    s3_key = s3_service.append_chat_message(chat.s3_messages_key, chat.id, g.tenant.id, user_msg_dict)
+    if s3_key:
+        chat.s3_messages_key = s3_key
+        chat.message_count = (chat.message_count or 0) + 1
+        chat.updated_at = datetime.utcnow()
+    db.session.commit()
+
+def _finish_chat_turn(chat, user_msg_dict, lex_response, transcript=None):
+    """
+    Store the user message, the AI response and its artifacts in S3 and
+    commit them in one go.
+
+    transcript: future from _prefetch_transcript, so only a HEAD (ETag check)
+    and the PUT are left here.
+
+    Returns (payload, status_code).
+    """
     # Create assistant message dict for S3
-    print("[DEBUG] 19. Creating assistant message dict for S3")
+    app.logger.debug("19. Creating assistant message dict for S3")
     assistant_msg_dict = {
         'role': 'assistant',
         'content': lex_response,
         'created_at': datetime.utcnow().isoformat()
     }
-    print("[DEBUG] 20. Assistant message dict created")
+    app.logger.debug("20. Assistant message dict created")
 
-    # Append to S3
-    print("[DEBUG] 21. Appending assistant response to S3...")
+    # Append user + assistant message to S3 in one GET+PUT
+    app.logger.debug("21. Appending user message and assistant response to S3...")
     try:
         s3_key = s3_service.append_chat_message(
             chat.s3_messages_key,
             chat.id,
             g.tenant.id,
-            assistant_msg_dict
+            [user_msg_dict, assistant_msg_dict],
+            existing=transcript.result() if transcript else None
         )
-        print(f"[DEBUG] 22. S3 append returned: {s3_key}")
+        app.logger.debug("22. S3 append returned: %s", s3_key)
     except Exception as e:
-        print(f"[DEBUG] ERROR appending assistant message to S3: {str(e)}")
-        import traceback
-        traceback.print_exc()
+        app.logger.exception("Error appending assistant message to S3: %s", e)
+        db.session.commit()
         raise
 
     if not s3_key:
-        print("[DEBUG] 23. S3 returned None - returning error")
-        return jsonify({'error': 'Kon AI response niet opslaan. Probeer het opnieuw.'}), 500
+        app.logger.debug("23. S3 returned None - returning error")
+        db.session.commit()
+        return {'error': 'Kon AI response niet opslaan. Probeer het opnieuw.'}, 500
 
-    print("[DEBUG] 24. Updating chat with assistant message...")
+    app.logger.debug("24. Updating chat with assistant message...")
     chat.s3_messages_key = s3_key
-    chat.message_count = (chat.message_count or 0) + 1
+    chat.message_count = (chat.message_count or 0) + 2
     chat.updated_at = datetime.utcnow()
-    print(f"[DEBUG] 25. Committing final database update (message_count={chat.message_count})")
+
+    # Store last message ID for artifacts (use message_count as ID)
+    assistant_message_id = chat.message_count
+    app.logger.debug("25. Processing artifacts (message_id=%s)", assistant_message_id)
+
+    found_artifacts = [
+        (match.group(1).strip(), match.group(2).strip(), match.group(3).strip())
+        for match in ARTIFACT_RE.finditer(lex_response)
+    ]
+
+    # Artifacts gaan zonder s3_key de transactie in; de S3-upload volgt na de commit
+    artifacts_to_commit = [
+        Artifact(
+            tenant_id=g.tenant.id,
+            chat_id=chat.id,
+            message_id=assistant_message_id,
+            title=title,
+            content=content,
+            artifact_type=artifact_type
+        )
+        for artifact_type, title, content in found_artifacts
+    ]
+    db.session.add_all(artifacts_to_commit)
+
+    # User message, assistant message and artifacts in one transaction
+    app.logger.debug("26. Committing chat update + %s artifacts (message_count=%s)", len(artifacts_to_commit), chat.message_count)
     try:
         db.session.commit()
-        print("[DEBUG] 26. Final database commit successful!")
+        app.logger.debug("27. Final database commit successful!")
     except Exception as e:
-        print(f"[DEBUG] ERROR in final database commit: {str(e)}")
-        import traceback
-        traceback.print_exc()
+        app.logger.exception("Error in final database commit: %s", e)
         db.session.rollback()
         raise
-    
-    # Store last message ID for artifacts (use message_count as ID)
-    assistant_message_id = chat.message_count
-    print(f"[DEBUG] 27. Processing artifacts (message_id={assistant_message_id})")
-
-    artifacts_created = []
-    artifact_pattern = r'```artifact:(\w+)\s+title:([^\n]+)\n(.*?)```'
-    matches = re.finditer(artifact_pattern, lex_response, re.DOTALL)
-
-    artifacts_to_commit = []
-    print("[DEBUG] 28. Searching for artifact patterns in response...")
-    for match in matches:
-        artifact_type = match.group(1).strip()
-        title = match.group(2).strip()
-        content = match.group(3).strip()
-        
-        s3_key = s3_service.upload_content(
-            content=content,
-            filename=f"{title}.txt",
-            tenant_id=g.tenant.id,
-            folder='artifacts'
-        )
-        
-        if s3_key:
-            artifact = Artifact(
-                tenant_id=g.tenant.id,
-                chat_id=chat.id,
-                message_id=assistant_message_id,
-                title=title,
-                content=content,
-                artifact_type=artifact_type,
-                s3_key=s3_key
-            )
-            db.session.add(artifact)
-            artifacts_to_commit.append(artifact)
-    
+
     if artifacts_to_commit:
-        print(f"[DEBUG] 29. Committing {len(artifacts_to_commit)} artifacts to database...")
-        try:
-            db.session.commit()
-            print("[DEBUG] 30. Artifacts committed successfully")
-            for artifact in artifacts_to_commit:
-                artifacts_created.append({
-                    'id': artifact.id,
-                    'title': artifact.title,
-                    'type': artifact.artifact_type,
-                    'content': artifact.content
-                })
-            print(f"[DEBUG] 31. Created {len(artifacts_created)} artifacts")
-        except Exception as e:
-            print(f"[DEBUG] ERROR committing artifacts: {str(e)}")
-            import traceback
-            traceback.print_exc()
-            # Don't raise - artifacts are optional
-    else:
-        print("[DEBUG] 29. No artifacts found in response")
+        _upload_artifacts_in_background(artifacts_to_commit)
+
+    artifacts_created = [{
+        'id': artifact.id,
+        'title': artifact.title,
+        'type': artifact.artifact_type,
+        'content': artifact.content
+    } for artifact in artifacts_to_commit]
 
-    print("[DEBUG] 32. Preparing final response JSON...")
+    app.logger.debug("32. Preparing final response JSON...")
     response_json = {
         'response': lex_response,
         'artifacts': artifacts_created,
         'message_id': assistant_message_id,
         'feedback_rating': None
     }
-    print(f"[DEBUG] 33. Sending successful response (response length: {len(lex_response)} chars, {len(artifacts_created)} artifacts)")
-    return jsonify(response_json)
+    app.logger.debug("33. Sending successful response (response length: %s chars, %s artifacts)", len(lex_response), len(artifacts_created))
+    return response_json, 200
+
+@app.route('/api/chat/<int:chat_id>/message', methods=['POST'])
+@login_required
+@tenant_required
+@limiter.limit("30 per minute")
+def send_message(chat_id):
+    chat, user_msg_dict, ai_message, error_response = _prepare_chat_turn(chat_id)
+    if error_response is not None:
+        return error_response
+
+    transcript = _prefetch_transcript(chat)  # S3 GET loopt parallel aan de AI-call
+
+    app.logger.debug("14. About to call RAG service (Memgraph + DeepSeek)...")
+    app.logger.debug("    - ai_message length: %s chars", len(ai_message))
+    app.logger.debug("    - RAG service enabled: %s", rag_service.enabled)
+    try:
+        from cao_config import get_system_instruction
+        app.logger.debug("15. Imported cao_config successfully")
+        cao_instruction = get_system_instruction(g.tenant)
+        app.logger.debug("16. Got system instruction (length: %s chars)", len(cao_instruction))
+        app.logger.debug("17. Calling rag_service.chat() (Memgraph + DeepSeek)...")
+        lex_response = rag_service.chat(ai_message, system_instruction=cao_instruction)
+        app.logger.debug("18. RAG service response received (length: %s chars)", len(lex_response))
+        app.logger.debug("    - First 100 chars: %s...", lex_response[:100])
+    except Exception as e:
+        app.logger.exception("Error in RAG service call: %s", e)
+        _store_user_message_only(chat, user_msg_dict)
+        raise
+    
+    response_json, status_code = _finish_chat_turn(chat, user_msg_dict, lex_response, transcript)
+    return jsonify(response_json), status_code
+
+@app.route('/api/chat/<int:chat_id>/message/stream', methods=['POST'])
+@login_required
+@tenant_required
+@limiter.limit("30 per minute")
+def send_message_stream(chat_id):
+    """
+    send_message as Server-Sent Events: 'data' events carry response deltas
+    while DeepSeek generates, followed by one 'done' event with the same JSON
+    send_message returns (or an 'error' event).
+    """
+    def sse(payload, event=None):
+        prefix = f"event: {event}\n" if event else ""
+        return f"{prefix}data: {json.dumps(payload)}\n\n"
+
+    sse_headers = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+
+    chat, user_msg_dict, ai_message, error_response = _prepare_chat_turn(chat_id)
+    if error_response is not None:
+        if isinstance(error_response, tuple):
+            return error_response  # 4xx: JSON error, same as send_message
+        # 200 without an AI call (e.g. no attached file could be read): the
+        # answer still arrives as this stream's 'done' event
+        return Response(sse(error_response.get_json(), event='done'),
+                        mimetype='text/event-stream', headers=sse_headers)
+
+    from cao_config import get_system_instruction
+    cao_instruction = get_system_instruction(g.tenant)
+    transcript = _prefetch_transcript(chat)  # S3 GET loopt parallel aan de AI-stream
+
+    def generate():
+        chunks = []
+        stream = rag_service.chat_stream(ai_message, system_instruction=cao_instruction)
+        try:
+            for delta in stream:
+                chunks.append(delta)
+                yield sse({'delta': delta})
+        except GeneratorExit:
+            # Client weg (tab dicht / netwerk weg): de beurt toch opslaan, net als
+            # send_message, met het deel van het antwoord dat al binnen was
+            stream.close()
+            app.logger.info("Client left chat %s stream after %s deltas", chat.id, len(chunks))
+            try:
+                if chunks:
+                    _finish_chat_turn(chat, user_msg_dict, ''.join(chunks), transcript)
+                else:
+                    _store_user_message_only(chat, user_msg_dict)
+            except Exception as e:
+                app.logger.exception("Storing chat turn after disconnect failed: %s", e)
+            raise
+        except Exception as e:
+            app.logger.exception("Error in RAG stream: %s", e)
+            _store_user_message_only(chat, user_msg_dict)
+            yield sse({'error': 'Er ging iets mis bij het verwerken van je vraag. Probeer het opnieuw.'}, event='error')
+            return
+
+        response_json, status_code = _finish_chat_turn(chat, user_msg_dict, ''.join(chunks), transcript)
+        yield sse(response_json, event='done' if status_code == 200 else 'error')
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype='text/event-stream',
+        headers=sse_headers
+    )
 
 @app.route('/api/chat/<int:chat_id>/rename', methods=['POST'])
 @login_required
@@ -1480,7 +1756,7 @@ def rename_chat(chat_id):
         user_id=current_user.id
     ).first_or_404()
     
-    data = request.json or {}
+    data = request.get_json(silent=True) or {}
     new_title = data.get('title', '').strip()
     
     if new_title:
@@ -1500,28 +1776,23 @@ def delete_chat(chat_id):
         user_id=current_user.id
     ).first_or_404()
     
-    # Delete uploaded files and their S3 objects
-    uploaded_files = UploadedFile.query.filter_by(chat_id=chat.id).all()
-    for uploaded_file in uploaded_files:
-        if uploaded_file.s3_key:
-            s3_service.delete_file(uploaded_file.s3_key)
-        db.session.delete(uploaded_file)
+    # S3 keys van bijlagen, artifacts en het berichtenbestand; de rijen gaan in bulk weg
+    s3_keys = [chat.s3_messages_key]
+    s3_keys += [k for (k,) in UploadedFile.query.filter_by(chat_id=chat.id).with_entities(UploadedFile.s3_key)]
+    s3_keys += [k for (k,) in Artifact.query.filter_by(chat_id=chat.id).with_entities(Artifact.s3_key)]
     
-    # Delete artifacts and their S3 objects
-    artifacts = Artifact.query.filter_by(chat_id=chat.id).all()
-    for artifact in artifacts:
-        if artifact.s3_key:
-            s3_service.delete_file(artifact.s3_key)
-        db.session.delete(artifact)
+    UploadedFile.query.filter_by(chat_id=chat.id).delete(synchronize_session=False)
+    Artifact.query.filter_by(chat_id=chat.id).delete(synchronize_session=False)
+    # Ook de (legacy) Message-rijen in bulk; de ORM cascade laadt dan een lege collectie
+    Message.query.filter_by(chat_id=chat.id).delete(synchronize_session=False)
     
-    # Delete S3 messages file
-    if chat.s3_messages_key:
-        s3_service.delete_file(chat.s3_messages_key)
-    
-    # Finally delete the chat itself (cascade will delete messages)
+    # Finally delete the chat itself
     db.session.delete(chat)
     db.session.commit()
     
+    # Alle S3 objecten in een DeleteObjects call i.p.v. een round-trip per object
+    s3_service.delete_files(s3_keys)
+    
     return jsonify({'success': True})
 
 @app.route('/api/user/accept-first-chat-warning', methods=['POST'])
@@ -1537,15 +1808,33 @@ def accept_first_chat_warning():
 @login_required
 @tenant_required
 def get_chats():
-    chats = Chat.query.filter_by(
+    # Keyset paginering op (updated_at, id): ?before_updated_at=<cursor>&before_id=<id>&limit=<n>
+    # Seekt via idx_chats_tenant_user_updated_id, ook diep in de historie
+    limit = max(1, min(request.args.get('limit', CHAT_PAGE_SIZE, type=int), 100))
+    # Kolommen als rijen (geen ORM-objecten/identity map); de JSON heeft alleen deze drie nodig
+    query = Chat.query.with_entities(Chat.id, Chat.title, Chat.updated_at).filter_by(
         tenant_id=g.tenant.id,
         user_id=current_user.id
-    ).order_by(Chat.updated_at.desc()).all()
+    )
+    
+    before_updated_at = request.args.get('before_updated_at')
+    if before_updated_at:
+        before_id = request.args.get('before_id', type=int)
+        try:
+            before_updated_at = datetime.fromisoformat(before_updated_at)
+        except ValueError:
+            return jsonify({'error': 'Ongeldige before_updated_at parameter'}), 400
+        if before_id is None:
+            return jsonify({'error': 'before_id ontbreekt'}), 400
+        query = query.filter(tuple_(Chat.updated_at, Chat.id) < tuple_(before_updated_at, before_id))
+    
+    chats = query.order_by(Chat.updated_at.desc(), Chat.id.desc()).limit(limit).all()
     
     return jsonify([{
         'id': chat.id,
         'title': chat.title,
-        'updated_at': chat.updated_at.strftime('%d/%m %H:%M')
+        'updated_at': chat.updated_at.strftime('%d/%m %H:%M'),
+        'cursor': chat.updated_at.isoformat()
     } for chat in chats])
 
 @app.route('/api/chats/search', methods=['POST'])
@@ -1609,6 +1898,11 @@ def export_chat_pdf(chat_id):
         user_id=current_user.id
     ).first_or_404()
     
+    # One timestamp for the document header, the filename and messages without one
+    now = datetime.now()
+    export_date = now.strftime('%d-%m-%Y %H:%M')
+    file_date = now.strftime('%Y%m%d')
+    
     # Collect messages
     messages = []
     if chat.s3_messages_key:
@@ -1616,7 +1910,7 @@ def export_chat_pdf(chat_id):
         if messages_data and 'messages' in messages_data:
             for msg in messages_data['messages']:
                 role = "Jij" if msg.get('role') == "user" else "Lexi"
-                timestamp = msg.get('timestamp', datetime.now().isoformat())
+                timestamp = msg.get('timestamp') or now.isoformat()
                 try:
                     dt = datetime.fromisoformat(timestamp.replace('Z', '+00:00'))
                     timestamp_str = dt.strftime('%d-%m-%Y %H:%M')
@@ -1628,8 +1922,8 @@ def export_chat_pdf(chat_id):
                     'content': msg.get('content', '')
                 })
     else:
-        # Fallback naar oude Message tabel
-        db_messages = Message.query.filter_by(chat_id=chat.id).order_by(Message.created_at).all()
+        # Fallback naar oude Message tabel; in batches van 500 i.p.v. alle ORM-objecten tegelijk
+        db_messages = Message.query.filter_by(chat_id=chat.id).order_by(Message.created_at).yield_per(500)
         for msg in db_messages:
             role = "Jij" if msg.role == "user" else "Lexi"
             messages.append({
@@ -1682,7 +1976,7 @@ def export_chat_pdf(chat_id):
         # Header
         story.append(Paragraph("Lexi CAO Meester - Chat Export", title_style))
         story.append(Paragraph(f"<b>Titel:</b> {chat.title}", header_style))
-        story.append(Paragraph(f"<b>Datum:</b> {datetime.now().strftime('%d-%m-%Y %H:%M')}", header_style))
+        story.append(Paragraph(f"<b>Datum:</b> {export_date}", header_style))
         story.append(Paragraph(f"<b>Gebruiker:</b> {current_user.full_name}", header_style))
         story.append(Spacer(1, 0.5*cm))
         
@@ -1708,7 +2002,7 @@ def export_chat_pdf(chat_id):
         return Response(
             buffer.getvalue(),
             mimetype='application/pdf',
-            headers={'Content-Disposition': f'attachment; filename=chat_{chat_id}_{datetime.now().strftime("%Y%m%d")}.pdf'}
+            headers={'Content-Disposition': f'attachment; filename=chat_{chat_id}_{file_date}.pdf'}
         )
     
     elif export_format == 'docx':
@@ -1729,7 +2023,7 @@ def export_chat_pdf(chat_id):
         
         # Metadata
         doc.add_paragraph(f"Titel: {chat.title}")
-        doc.add_paragraph(f"Datum: {datetime.now().strftime('%d-%m-%Y %H:%M')}")
+        doc.add_paragraph(f"Datum: {export_date}")
         doc.add_paragraph(f"Gebruiker: {current_user.full_name}")
         doc.add_paragraph('_' * 80)
         doc.add_paragraph()
@@ -1761,7 +2055,7 @@ def export_chat_pdf(chat_id):
         return Response(
             buffer.getvalue(),
             mimetype='application/vnd.openxmlformats-officedocument.wordprocessingml.document',
-            headers={'Content-Disposition': f'attachment; filename=chat_{chat_id}_{datetime.now().strftime("%Y%m%d")}.docx'}
+            headers={'Content-Disposition': f'attachment; filename=chat_{chat_id}_{file_date}.docx'}
         )
     
     else:
@@ -1802,7 +2096,9 @@ def download_artifact(artifact_id):
         tenant_id=g.tenant.id
     ).first_or_404()
     
-    download_url = s3_service.get_file_url(artifact.s3_key, expiration=300)
+    # Upload na de chat-response nog niet klaar (of mislukt): nu alsnog uploaden
+    s3_key = artifact.s3_key or upload_artifact_to_s3(artifact.id, artifact.tenant_id, artifact.title, artifact.content)
+    download_url = s3_service.get_file_url(s3_key) if s3_key else None
     
     if not download_url:
         return jsonify({'error': 'Download niet beschikbaar'}), 500
@@ -1817,7 +2113,7 @@ def download_artifact(artifact_id):
 @login_required
 @tenant_required
 def get_chat_files(chat_id):
-    if g.tenant.subscription_status not in ['active', 'trial', 'trialing']:
+    if not g.subscription_active:
         return jsonify({'error': 'Subscription niet actief'}), 403
     
     chat = Chat.query.filter_by(
@@ -1846,7 +2142,7 @@ def get_chat_files(chat_id):
 @login_required
 @tenant_required
 def delete_file(file_id):
-    if g.tenant.subscription_status not in ['active', 'trial', 'trialing']:
+    if not g.subscription_active:
         return jsonify({'error': 'Subscription niet actief'}), 403
     
     uploaded_file = UploadedFile.query.filter_by(
@@ -1870,7 +2166,7 @@ def delete_file(file_id):
 @login_required
 @tenant_required
 def view_file(file_id):
-    if g.tenant.subscription_status not in ['active', 'trial', 'trialing']:
+    if not g.subscription_active:
         return jsonify({'error': 'Subscription niet actief'}), 403
     
     uploaded_file = UploadedFile.query.filter_by(
@@ -1881,7 +2177,7 @@ def view_file(file_id):
     
     # For PDF, return presigned URL for direct browser access
     if uploaded_file.mime_type == 'application/pdf':
-        download_url = s3_service.get_file_url(uploaded_file.s3_key, expiration=3600)
+        download_url = s3_service.get_file_url(uploaded_file.s3_key)
         if not download_url:
             return jsonify({'error': 'Kon bestand niet ophalen'}), 500
         
@@ -1901,11 +2197,92 @@ def view_file(file_id):
         'content': content
     })
 
+# SECURITY: File type whitelist - only allow specific document types
+UPLOAD_ALLOWED_EXTENSIONS = {'pdf', 'docx', 'doc', 'txt'}
+UPLOAD_ALLOWED_MIMETYPES = {
+    'application/pdf',
+    'application/vnd.openxmlformats-officedocument.wordprocessingml.document',
+    'application/msword',
+    'text/plain'
+}
+
+def _validate_upload(filename, content_type):
+    """Returns (safe_filename, None) or (None, error_response)"""
+    filename = secure_filename(filename or '')
+    if not filename or '.' not in filename:
+        return None, (jsonify({'error': 'Ongeldig bestand'}), 400)
+    
+    file_ext = filename.rsplit('.', 1)[1].lower()
+    if file_ext not in UPLOAD_ALLOWED_EXTENSIONS:
+        return None, (jsonify({'error': f'Alleen {", ".join(UPLOAD_ALLOWED_EXTENSIONS).upper()} bestanden toegestaan'}), 400)
+    
+    if content_type not in UPLOAD_ALLOWED_MIMETYPES:
+        return None, (jsonify({'error': 'Ongeldig bestandstype'}), 400)
+    
+    return filename, None
+
+@lru_cache(maxsize=1)
+def _markitdown():
+    """MarkItDown converter, imported on first PDF upload (None if not installed).
+
+    markitdown pulls in every converter plus magika/onnxruntime at import time;
+    only the PDF path needs it, so it stays out of app startup.
+    """
+    try:
+        from markitdown import MarkItDown
+    except (ImportError, AttributeError) as e:
+        print(f"⚠️  MarkItDown not available: {e}")
+        return None
+    return MarkItDown()
+
+def extract_pdf_text(file_data):
+    """Extract text from PDF bytes using MarkItDown + OCR fallback (None on failure)"""
+    extracted_text = None
+    try:
+        # Save to temporary file for MarkItDown processing
+        with tempfile.NamedTemporaryFile(delete=False, suffix='.pdf') as tmp_file:
+            tmp_file.write(file_data)
+            tmp_path = tmp_file.name
+        
+        # Extract text using MarkItDown
+        md = _markitdown()
+        if md is not None:
+            extracted_text = md.convert(tmp_path).text_content
+        
+        # If MarkItDown didn't extract text (scanned PDF), use OCR
+        if not extracted_text or len(extracted_text.strip()) == 0:
+            app.logger.debug("MarkItDown extracted no text, trying OCR...")
+            try:
+                # Convert PDF pages to images
+                images = convert_from_path(tmp_path)
+                ocr_texts = []
+                
+                for i, image in enumerate(images):
+                    # Extract text from each page using Tesseract OCR
+                    page_text = pytesseract.image_to_string(image, lang='nld+eng')
+                    if page_text.strip():
+                        ocr_texts.append(f"--- Pagina {i+1} ---\n{page_text}")
+                
+                if ocr_texts:
+                    extracted_text = '\n\n'.join(ocr_texts)
+                    app.logger.debug("OCR successful, extracted %s characters from %s pages", len(extracted_text), len(images))
+                else:
+                    app.logger.debug("OCR found no text in PDF")
+            except Exception as ocr_error:
+                app.logger.debug("OCR failed: %s", ocr_error)
+        
+        # Clean up temporary file
+        os.unlink(tmp_path)
+    except Exception as e:
+        print(f"Error extracting PDF text: {e}")
+    return extracted_text
+
 @app.route('/api/upload', methods=['POST'])
 @login_required
 @tenant_required
 def upload_file():
-    if g.tenant.subscription_status not in ['active', 'trial', 'trialing']:
+    """Upload through the app server (fallback when direct-to-S3 upload is not possible)"""
+    if not g.subscription_active:
         return jsonify({'error': 'Subscription niet actief'}), 403
     
     if 'file' not in request.files:
@@ -1915,25 +2292,9 @@ def upload_file():
     if file.filename == '':
         return jsonify({'error': 'Geen bestand geselecteerd'}), 400
     
-    # SECURITY: File type whitelist - only allow specific document types
-    ALLOWED_EXTENSIONS = {'pdf', 'docx', 'doc', 'txt'}
-    ALLOWED_MIMETYPES = {
-        'application/pdf',
-        'application/vnd.openxmlformats-officedocument.wordprocessingml.document',
-        'application/msword',
-        'text/plain'
-    }
-    
-    filename = secure_filename(file.filename)
-    if not filename or '.' not in filename:
-        return jsonify({'error': 'Ongeldig bestand'}), 400
-    
-    file_ext = filename.rsplit('.', 1)[1].lower()
-    if file_ext not in ALLOWED_EXTENSIONS:
-        return jsonify({'error': f'Alleen {", ".join(ALLOWED_EXTENSIONS).upper()} bestanden toegestaan'}), 400
-    
-    if file.content_type not in ALLOWED_MIMETYPES:
-        return jsonify({'error': 'Ongeldig bestandstype'}), 400
+    filename, error_response = _validate_upload(file.filename, file.content_type)
+    if error_response is not None:
+        return error_response
     
     chat_id = request.form.get('chat_id')
     
@@ -1945,52 +2306,9 @@ def upload_file():
     # Extract text from PDF using MarkItDown + OCR fallback
     extracted_text = None
     if file.content_type == 'application/pdf':
-        try:
-            # Read file data for MarkItDown
-            file.seek(0)
-            file_data = file.read()
-            
-            # Save to temporary file for MarkItDown processing
-            with tempfile.NamedTemporaryFile(delete=False, suffix='.pdf') as tmp_file:
-                tmp_file.write(file_data)
-                tmp_path = tmp_file.name
-            
-            # Extract text using MarkItDown
-            md = MarkItDown()
-            result = md.convert(tmp_path)
-            extracted_text = result.text_content
-            
-            # If MarkItDown didn't extract text (scanned PDF), use OCR
-            if not extracted_text or len(extracted_text.strip()) == 0:
-                print(f"[DEBUG] MarkItDown extracted no text, trying OCR...")
-                try:
-                    # Convert PDF pages to images
-                    images = convert_from_path(tmp_path)
-                    ocr_texts = []
-                    
-                    for i, image in enumerate(images):
-                        # Extract text from each page using Tesseract OCR
-                        page_text = pytesseract.image_to_string(image, lang='nld+eng')
-                        if page_text.strip():
-                            ocr_texts.append(f"--- Pagina {i+1} ---\n{page_text}")
-                    
-                    if ocr_texts:
-                        extracted_text = '\n\n'.join(ocr_texts)
-                        print(f"[DEBUG] OCR successful, extracted {len(extracted_text)} characters from {len(images)} pages")
-                    else:
-                        print(f"[DEBUG] OCR found no text in PDF")
-                except Exception as ocr_error:
-                    print(f"[DEBUG] OCR failed: {ocr_error}")
-            
-            # Clean up temporary file
-            os.unlink(tmp_path)
-            
-            # Reset file pointer for S3 upload
-            file.seek(0)
-        except Exception as e:
-            print(f"Error extracting PDF text: {e}")
-            # Reset file pointer and continue without extracted text
-            file.seek(0)
+        extracted_text = extract_pdf_text(file.read())
+        # Reset file pointer for S3 upload
+        file.seek(0)
     
     # Upload to S3
     s3_key = s3_service.upload_file(file, g.tenant.id)
@@ -2013,6 +2331,86 @@ def upload_file():
     
     return jsonify({'success': True, 'file_id': uploaded_file.id})
 
+@app.route('/api/upload/presign', methods=['POST'])
+@login_required
+@tenant_required
+def presign_upload():
+    """Presigned PUT URL so the browser uploads the file straight to S3"""
+    if not g.subscription_active:
+        return jsonify({'error': 'Subscription niet actief'}), 403
+    
+    if not s3_service.enabled:
+        return jsonify({'error': 'S3 niet geconfigureerd'}), 503
+    
+    data = request.get_json(silent=True) or {}
+    mime_type = data.get('mime_type')
+    filename, error_response = _validate_upload(data.get('filename'), mime_type)
+    if error_response is not None:
+        return error_response
+    
+    size = data.get('size')
+    if not isinstance(size, int) or size <= 0 or size > app.config['MAX_CONTENT_LENGTH']:
+        return jsonify({'error': 'Ongeldige bestandsgrootte'}), 400
+    
+    s3_key, url = s3_service.generate_upload_url(filename, mime_type, size, g.tenant.id)
+    if not url:
+        return jsonify({'error': 'Upload mislukt'}), 500
+    
+    return jsonify({'url': url, 's3_key': s3_key})
+
+@app.route('/api/upload/complete', methods=['POST'])
+@login_required
+@tenant_required
+def complete_upload():
+    """Register a file the browser uploaded to S3 via /api/upload/presign"""
+    if not g.subscription_active:
+        return jsonify({'error': 'Subscription niet actief'}), 403
+    
+    data = request.get_json(silent=True) or {}
+    s3_key = data.get('s3_key') or ''
+    mime_type = data.get('mime_type')
+    original_filename = data.get('filename') or ''
+    chat_id = data.get('chat_id')
+    
+    # SECURITY: only keys from this tenant's upload prefix (as issued by presign)
+    if not s3_key.startswith(f"uploads/tenant_{g.tenant.id}/") or '..' in s3_key:
+        return jsonify({'error': 'Ongeldig bestand'}), 400
+    
+    _, error_response = _validate_upload(original_filename, mime_type)
+    if error_response is not None:
+        return error_response
+    
+    # Size from S3 itself, not from the client
+    file_size = s3_service.get_file_size(s3_key)
+    if file_size is None:
+        return jsonify({'error': 'Bestand niet gevonden in opslag'}), 400
+    if file_size > app.config['MAX_CONTENT_LENGTH']:
+        s3_service.delete_file(s3_key)
+        return jsonify({'error': 'Bestand is te groot'}), 400
+    
+    # PDF text extraction needs the bytes: fetched from S3, not from the browser
+    extracted_text = None
+    if mime_type == 'application/pdf':
+        file_data = s3_service.download_file_bytes(s3_key)
+        if file_data:
+            extracted_text = extract_pdf_text(file_data)
+    
+    uploaded_file = UploadedFile(
+        tenant_id=g.tenant.id,
+        user_id=current_user.id,
+        chat_id=chat_id if chat_id else None,
+        filename=original_filename,
+        original_filename=original_filename,
+        s3_key=s3_key,
+        file_size=file_size,
+        mime_type=mime_type,
+        extracted_text=extracted_text
+    )
+    db.session.add(uploaded_file)
+    db.session.commit()
+    
+    return jsonify({'success': True, 'file_id': uploaded_file.id})
+
 # Support Ticket Routes (Customer)
 @app.route('/support')
 @login_required
@@ -2148,47 +2546,55 @@ def close_support_ticket(ticket_id):
 @tenant_required
 @admin_required
 def admin_dashboard():
-    users = User.query.filter_by(tenant_id=g.tenant.id).all()
-    total_chats = Chat.query.filter_by(tenant_id=g.tenant.id).count()
-    subscription = Subscription.query.filter_by(tenant_id=g.tenant.id).first()
-    
-    total_messages = Message.query.filter_by(
-        tenant_id=g.tenant.id,
-        role='user'
-    ).count()
-    
+    tenant_id = g.tenant.id
     thirty_days_ago = datetime.utcnow() - timedelta(days=30)
-    messages_this_month = Message.query.filter(
-        Message.tenant_id == g.tenant.id,
-        Message.role == 'user',
-        Message.created_at >= thirty_days_ago
-    ).count()
-    
-    active_users_ids = db.session.query(Chat.user_id).filter(
-        Chat.tenant_id == g.tenant.id,
-        Chat.updated_at >= thirty_days_ago
-    ).distinct().all()
-    active_users_count = len(active_users_ids)
-    
-    top_users = db.session.query(
-        User,
+
+    # All counters in one round-trip: one SELECT of scalar subqueries
+    stats = db.session.query(
+        db.session.query(db.func.count(User.id)).filter(
+            User.tenant_id == tenant_id
+        ).scalar_subquery().label('user_count'),
+        db.session.query(db.func.count(Chat.id)).filter(
+            Chat.tenant_id == tenant_id
+        ).scalar_subquery().label('total_chats'),
+        db.session.query(db.func.count(Message.id)).filter(
+            Message.tenant_id == tenant_id,
+            Message.role == 'user'
+        ).scalar_subquery().label('total_messages'),
+        db.session.query(db.func.count(Message.id)).filter(
+            Message.tenant_id == tenant_id,
+            Message.role == 'user',
+            Message.created_at >= thirty_days_ago
+        ).scalar_subquery().label('messages_this_month'),
+        db.session.query(db.func.count(db.distinct(Chat.user_id))).filter(
+            Chat.tenant_id == tenant_id,
+            Chat.updated_at >= thirty_days_ago
+        ).scalar_subquery().label('active_users_count')
+    ).one()
+    
+    # Tellen en top 5 kiezen alleen over chats (index-only op tenant_id, user_id, id);
+    # daarna pas de 5 users erbij voor naam en email
+    chat_counts = db.session.query(
+        Chat.user_id,
         db.func.count(Chat.id).label('chat_count')
-    ).join(Chat, User.id == Chat.user_id
     ).filter(
-        User.tenant_id == g.tenant.id,
         Chat.tenant_id == g.tenant.id
-    ).group_by(User.id
+    ).group_by(Chat.user_id
     ).order_by(db.desc('chat_count')
-    ).limit(5).all()
+    ).limit(5).subquery()
+    top_users = db.session.query(User, chat_counts.c.chat_count).options(
+        load_only(User.id, User.first_name, User.last_name, User.email)
+    ).join(chat_counts, User.id == chat_counts.c.user_id
+    ).filter(User.tenant_id == g.tenant.id
+    ).order_by(chat_counts.c.chat_count.desc()).all()
     
     return render_template('admin_dashboard.html', 
                          tenant=g.tenant, 
-                         users=users, 
-                         total_chats=total_chats,
-                         subscription=subscription,
-                         total_messages=total_messages,
-                         messages_this_month=messages_this_month,
-                         active_users_count=active_users_count,
+                         user_count=stats.user_count, 
+                         total_chats=stats.total_chats,
+                         total_messages=stats.total_messages,
+                         messages_this_month=stats.messages_this_month,
+                         active_users_count=stats.active_users_count,
                          top_users=top_users)
 
 @app.route('/admin/cao/update', methods=['POST'])
@@ -2220,11 +2626,6 @@ def admin_users():
         action = request.form.get('action')
         
         if action == 'add':
-            current_user_count = User.query.filter_by(tenant_id=g.tenant.id).count()
-            if current_user_count >= g.tenant.max_users:
-                flash(f'Maximum aantal gebruikers bereikt ({g.tenant.max_users}). Upgrade je plan.', 'warning')
-                return redirect(url_for('admin_users'))
-            
             email = request.form.get('email')
             first_name = request.form.get('first_name')
             last_name = request.form.get('last_name')
@@ -2234,8 +2635,10 @@ def admin_users():
             if role not in ['user', 'admin']:
                 role = 'user'
             
-            if User.query.filter_by(tenant_id=g.tenant.id, email=email).first():
+            if db.session.query(User.query.filter_by(tenant_id=g.tenant.id, email=email).exists()).scalar():
                 flash('Deze email is al in gebruik.', 'danger')
+            elif not reserve_user_seat(g.tenant.id):
+                flash(f'Maximum aantal gebruikers bereikt ({g.tenant.max_users}). Upgrade je plan.', 'warning')
             else:
                 user = User(
                     tenant_id=g.tenant.id,
@@ -2286,6 +2689,7 @@ def admin_users():
             user = User.query.filter_by(id=user_id, tenant_id=g.tenant.id).first()
             if user and user.id != current_user.id:
                 db.session.delete(user)
+                release_user_seat(g.tenant.id)
                 db.session.commit()
                 flash('Gebruiker verwijderd.', 'success')
         
@@ -2504,16 +2908,18 @@ def billing_success():
 @app.route('/webhook/stripe', methods=['POST'])
 @limiter.limit("100 per hour")
 def stripe_webhook():
-    payload = request.data
-    sig_header = request.headers.get('Stripe-Signature')
     # Productie webhook secret heeft voorrang over test webhook secret
     webhook_secret = os.getenv('STRIPE_WEBHOOK_SECRET_PROD') or os.getenv('STRIPE_WEBHOOK_SECRET')
     
-    # SECURITY: Webhook secret MUST be configured
+    # SECURITY: Webhook secret MUST be configured (checked before reading the body)
     if not webhook_secret:
         print("❌ CRITICAL: STRIPE_WEBHOOK_SECRET not configured - webhook rejected")
         return jsonify({'error': 'Webhook not properly configured'}), 500
     
+    # Body is only needed for the signature check; don't keep a cached copy on the request
+    payload = request.get_data(cache=False)
+    sig_header = request.headers.get('Stripe-Signature')
+    
     is_prod_webhook = bool(os.getenv('STRIPE_WEBHOOK_SECRET_PROD'))
     print(f"📥 Webhook received - Mode: {'Production' if is_prod_webhook else 'Test'}")
     
@@ -2527,7 +2933,25 @@ def stripe_webhook():
     except Exception as e:
         print(f"❌ Webhook processing error: {e}")
         return jsonify({'error': 'Webhook error'}), 400
+    del payload
     
+    # Stripe retries deliveries; an event that was handled successfully is skipped.
+    # Recorded in PostgreSQL so the check holds across all gunicorn workers.
+    if db.session.get(ProcessedStripeEvent, event['id']) is not None:
+        print(f"ℹ️  Webhook event {event['id']} already processed - skipping")
+        return jsonify({'success': True, 'message': 'Already processed'})
+    
+    response = app.make_response(_process_stripe_event(event))
+    if response.status_code == 200:
+        try:
+            db.session.add(ProcessedStripeEvent(event_id=event['id'], event_type=event['type']))
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()  # a concurrent delivery of the same event recorded it first
+    return response
+
+def _process_stripe_event(event):
+    """Handle a verified Stripe event; returns the webhook response"""
     if event['type'] == 'checkout.session.completed':
         from models import PendingSignup
         from provision_tenant import provision_tenant_from_signup
@@ -2578,12 +3002,16 @@ def stripe_webhook():
         old_plan_id = subscription_obj.get('previous_attributes', {}).get('items', {}).get('data', [{}])[0].get('price', {}).get('id')
         new_plan_id = subscription_obj.get('items', {}).get('data', [{}])[0].get('price', {}).get('id')
         
-        subscription = Subscription.query.filter_by(stripe_subscription_id=stripe_sub_id).first()
+        # Subscription + tenant in one query; updates stay ORM-level so the
+        # model cache invalidation events fire for the tenant
+        subscription = Subscription.query.options(joinedload(Subscription.tenant)).filter_by(
+            stripe_subscription_id=stripe_sub_id
+        ).first()
         if subscription:
             # Map Stripe status to our status
             if status in ['active', 'trialing']:
                 subscription.status = 'active'
-                tenant = Tenant.query.get(subscription.tenant_id)
+                tenant = subscription.tenant
                 if tenant:
                     tenant.status = 'active'
                     # Send subscription updated email if plan changed
@@ -2599,7 +3027,7 @@ def stripe_webhook():
                 subscription.status = 'past_due'
             elif status in ['canceled', 'incomplete_expired']:
                 subscription.status = 'canceled'
-                tenant = Tenant.query.get(subscription.tenant_id)
+                tenant = subscription.tenant
                 if tenant:
                     tenant.status = 'inactive'
                     # Send subscription cancelled email
@@ -2618,9 +3046,11 @@ def stripe_webhook():
         invoice = event['data']['object']
         customer_id = invoice.get('customer')
         
-        subscription = Subscription.query.filter_by(stripe_customer_id=customer_id).first()
+        subscription = Subscription.query.options(joinedload(Subscription.tenant)).filter_by(
+            stripe_customer_id=customer_id
+        ).first()
         if subscription:
-            tenant = Tenant.query.get(subscription.tenant_id)
+            tenant = subscription.tenant
             email_service.send_payment_failed_email(tenant)
             print(f"Payment failed email sent to {tenant.contact_email}")
     
@@ -2641,11 +3071,13 @@ def stripe_webhook():
             print(f"ℹ️  Skipping email for first invoice (already paid via Checkout)")
             return jsonify({'success': True, 'message': 'First invoice - no email needed'})
         
-        subscription = Subscription.query.filter_by(stripe_subscription_id=subscription_id).first()
+        subscription = Subscription.query.options(joinedload(Subscription.tenant)).filter_by(
+            stripe_subscription_id=subscription_id
+        ).first()
         
         # Only send email for iDEAL payment method (manual invoices)
         if subscription and subscription.payment_method == 'ideal':
-            tenant = Tenant.query.get(subscription.tenant_id)
+            tenant = subscription.tenant
             admin_user = User.query.filter_by(tenant_id=tenant.id, role='admin').first()
             
             if tenant and admin_user:
@@ -2681,14 +3113,71 @@ def stripe_webhook():
     
     return jsonify({'success': True})
 
+TENANT_STATS_TTL = 60  # seconds
+MRR_PRICES = {'starter': 499, 'professional': 599, 'enterprise': 1199}  # maandprijs per tier (EUR)
+
+def get_tenant_revenue_stats():
+    """
+    MRR, growth and tier/status counts over all tenants for the super admin
+    dashboard and analytics pages.
+
+    Computed from three Tenant columns and cached for TENANT_STATS_TTL seconds;
+    model_cache drops the entry as soon as a tenant is inserted, updated or
+    deleted.
+    """
+    stats = cache_service.get(TENANT_STATS_KEY)
+    if stats is not None:
+        return stats
+    
+    from dateutil.relativedelta import relativedelta
+    
+    # Funnel/tier-aantallen in één GROUP BY (status, tier): per combinatie één rij
+    tenant_counts = {
+        (status, tier): count
+        for status, tier, count in db.session.query(
+            Tenant.subscription_status, Tenant.subscription_tier, db.func.count(Tenant.id)
+        ).group_by(Tenant.subscription_status, Tenant.subscription_tier)
+    }
+    
+    # Alleen actieve tenants tellen mee in de MRR, op created_at gesorteerd met
+    # cumulatieve MRR: de MRR op een peildatum is dan een bisect i.p.v. een scan
+    active = db.session.query(Tenant.subscription_tier, Tenant.created_at).filter(
+        Tenant.subscription_status == 'active'
+    ).order_by(Tenant.created_at).all()
+    active_created_at = [r.created_at for r in active]
+    cumulative_mrr = list(accumulate((MRR_PRICES.get(r.subscription_tier, 0) for r in active), initial=0))
+    
+    now = datetime.utcnow()
+    current_mrr = cumulative_mrr[-1]
+    last_month_mrr = cumulative_mrr[bisect_left(active_created_at, now - relativedelta(months=1))]
+    
+    growth_rate = 0
+    if last_month_mrr > 0:
+        growth_rate = ((current_mrr - last_month_mrr) / last_month_mrr) * 100
+    elif current_mrr > 0 and last_month_mrr == 0:
+        growth_rate = 100
+    
+    month_dates = [now - relativedelta(months=i) for i in range(12, 0, -1)]
+    
+    stats = {
+        'total_tenants': sum(tenant_counts.values()),
+        'active_tenants': len(active),
+        'trial_tenants': sum(count for (status, _), count in tenant_counts.items() if status == 'trial'),
+        'trial_tier_tenants': sum(count for (_, tier), count in tenant_counts.items() if tier == 'trial'),
+        'active_per_tier': {tier: tenant_counts.get(('active', tier), 0) for tier in MRR_PRICES},
+        'current_mrr': current_mrr,
+        'growth_rate': growth_rate,
+        # (peildatum, MRR) voor dezelfde dag in elk van de afgelopen 12 maanden, oudste eerst
+        'mrr_history': [(d, cumulative_mrr[bisect_right(active_created_at, d)]) for d in month_dates],
+    }
+    cache_service.set(TENANT_STATS_KEY, stats, TENANT_STATS_TTL)
+    return stats
+
 @app.route('/super-admin/dashboard')
 @super_admin_required
 def super_admin_dashboard():
-    print(f"[DEBUG] Super Admin Dashboard accessed")
-    print(f"  Session is_super_admin: {session.get('is_super_admin')}")
-    print(f"  g.is_super_admin: {g.is_super_admin}")
-    print(f"  current_user: {current_user}")
-    print(f"  Request host: {request.host}")
+    app.logger.debug("Super Admin Dashboard accessed - is_super_admin: %s, current_user: %s, host: %s",
+                     g.is_super_admin, current_user, request.host)
 
     sort_by = request.args.get('sort_by', 'created_at')
     sort_order = request.args.get('sort_order', 'desc')
@@ -2703,45 +3192,35 @@ def super_admin_dashboard():
     
     sort_column = valid_sort_columns.get(sort_by, Tenant.created_at)
     
+    # Alleen de kolommen die de tenanttabel toont; users per tenant komt uit user_count
+    tenants_query = Tenant.query.options(load_only(
+        Tenant.id, Tenant.company_name, Tenant.subdomain, Tenant.contact_email, Tenant.status,
+        Tenant.subscription_status, Tenant.subscription_tier, Tenant.cao_preference,
+        Tenant.max_users, Tenant.user_count, Tenant.created_at
+    ))
     if sort_order == 'asc':
-        tenants = Tenant.query.order_by(sort_column.asc()).all()
+        tenants = tenants_query.order_by(sort_column.asc()).all()
     else:
-        tenants = Tenant.query.order_by(sort_column.desc()).all()
+        tenants = tenants_query.order_by(sort_column.desc()).all()
     
     total_users = User.query.count()
     
-    mrr_prices = {'starter': 499, 'professional': 599, 'enterprise': 1199}
-    
-    current_mrr = sum(mrr_prices.get(t.subscription_tier, 0) for t in tenants if t.subscription_status == 'active')
+    stats = get_tenant_revenue_stats()
+    current_mrr = stats['current_mrr']
     arr = current_mrr * 12
+    growth_percentage = stats['growth_rate']
     
-    from dateutil.relativedelta import relativedelta
-    last_month = datetime.utcnow() - relativedelta(months=1)
-    last_month_tenants = [t for t in tenants if t.created_at < last_month and t.subscription_status == 'active']
-    last_month_mrr = sum(mrr_prices.get(t.subscription_tier, 0) for t in last_month_tenants)
-    
-    growth_percentage = 0
-    if last_month_mrr > 0:
-        growth_percentage = ((current_mrr - last_month_mrr) / last_month_mrr) * 100
-    elif current_mrr > 0 and last_month_mrr == 0:
-        growth_percentage = 100
+    starter_count = stats['active_per_tier']['starter']
+    professional_count = stats['active_per_tier']['professional']
+    enterprise_count = stats['active_per_tier']['enterprise']
+    starter_mrr = starter_count * MRR_PRICES['starter']
+    professional_mrr = professional_count * MRR_PRICES['professional']
+    enterprise_mrr = enterprise_count * MRR_PRICES['enterprise']
     
-    starter_count = sum(1 for t in tenants if t.subscription_tier == 'starter' and t.subscription_status == 'active')
-    professional_count = sum(1 for t in tenants if t.subscription_tier == 'professional' and t.subscription_status == 'active')
-    enterprise_count = sum(1 for t in tenants if t.subscription_tier == 'enterprise' and t.subscription_status == 'active')
-    starter_mrr = starter_count * 499
-    professional_mrr = professional_count * 599
-    enterprise_mrr = enterprise_count * 1199
-    
-    mrr_history = []
-    for i in range(6, 0, -1):
-        month_date = datetime.utcnow() - relativedelta(months=i)
-        month_tenants = [t for t in tenants if t.created_at <= month_date and t.subscription_status == 'active']
-        month_mrr = sum(mrr_prices.get(t.subscription_tier, 0) for t in month_tenants)
-        mrr_history.append({
-            'month': month_date.strftime('%b'),
-            'mrr': month_mrr
-        })
+    mrr_history = [{
+        'month': month_date.strftime('%b'),
+        'mrr': month_mrr
+    } for month_date, month_mrr in stats['mrr_history'][-6:]]
     
     return render_template('super_admin_dashboard.html', 
                          tenants=tenants, 
@@ -3643,6 +4122,7 @@ def super_admin_impersonate(tenant_id):
     login_user(admin_user)
     
     session['tenant_id'] = tenant_id
+    session['is_super_admin'] = False
     
     flash(f'Nu ingelogd als {admin_user.full_name} ({tenant.company_name})', 'success')
     return redirect('/chat')
@@ -3684,10 +4164,18 @@ def super_admin_tenant_detail(tenant_id):
     
     users = User.query.filter_by(tenant_id=tenant_id).all()
     
-    total_questions = db.session.query(Message).join(Chat).filter(
+    # Vragen en laatste activiteit per gebruiker: twee GROUP BY queries i.p.v. twee queries per user
+    question_counts = dict(db.session.query(
+        Chat.user_id, db.func.count(Message.id)
+    ).join(Message).filter(
         Chat.tenant_id == tenant_id,
         Message.role == 'user'
-    ).count()
+    ).group_by(Chat.user_id).all())
+    last_activity = dict(db.session.query(
+        Chat.user_id, db.func.max(Chat.updated_at)
+    ).filter(Chat.tenant_id == tenant_id).group_by(Chat.user_id).all())
+    
+    total_questions = sum(question_counts.values())
     
     from datetime import datetime, timedelta
     from dateutil.relativedelta import relativedelta
@@ -3707,10 +4195,10 @@ def super_admin_tenant_detail(tenant_id):
     ).count()
     
     seven_days_ago = datetime.utcnow() - timedelta(days=7)
-    active_users_count = db.session.query(Chat.user_id).filter(
+    active_users_count = db.session.query(db.func.count(db.distinct(Chat.user_id))).filter(
         Chat.tenant_id == tenant_id,
         Chat.created_at >= seven_days_ago
-    ).distinct().count()
+    ).scalar()
     
     avg_questions = total_questions / len(users) if users else 0
     
@@ -3723,13 +4211,8 @@ def super_admin_tenant_detail(tenant_id):
     ).group_by(Message.content).order_by(db.desc('count')).limit(5).all()
     
     for user in users:
-        user.question_count = db.session.query(Message).join(Chat).filter(
-            Chat.user_id == user.id,
-            Message.role == 'user'
-        ).count()
-        user.last_activity = db.session.query(db.func.max(Chat.updated_at)).filter(
-            Chat.user_id == user.id
-        ).scalar()
+        user.question_count = question_counts.get(user.id, 0)
+        user.last_activity = last_activity.get(user.id)
     
     trial_days_left = None
     if tenant.trial_ends_at and tenant.subscription_status == 'trial':
@@ -3754,8 +4237,8 @@ def super_admin_reset_password(user_id):
     """Super admin can trigger password reset for any user (token-based, secure)"""
     from datetime import datetime, timedelta
     
-    user = User.query.get_or_404(user_id)
-    tenant = Tenant.query.get(user.tenant_id)
+    user = User.query.options(joinedload(User.tenant)).filter_by(id=user_id).first_or_404()
+    tenant = user.tenant
     
     # Generate secure reset token (super admin NEVER sees user password)
     reset_token = secrets.token_urlsafe(32)
@@ -3780,42 +4263,50 @@ def super_admin_reset_password(user_id):
 def super_admin_analytics_export():
     import csv
     from io import StringIO
-    from flask import Response
-    
-    tenants = Tenant.query.all()
     
-    output = StringIO()
-    writer = csv.writer(output)
-    
-    writer.writerow(['Tenant ID', 'Company Name', 'Subdomain', 'Status', 'Tier', 'MRR', 'Users', 'Questions', 'Created At'])
+    tenants = Tenant.query.with_entities(
+        Tenant.id, Tenant.company_name, Tenant.subdomain, Tenant.subscription_status,
+        Tenant.subscription_tier, Tenant.created_at
+    ).all()
     
-    mrr_prices = {'starter': 499, 'professional': 599, 'enterprise': 1199}
+    # Aantallen voor alle tenants in twee GROUP BY queries i.p.v. twee COUNTs per tenant
+    user_counts = dict(db.session.query(User.tenant_id, db.func.count(User.id)).group_by(User.tenant_id).all())
+    question_counts = dict(db.session.query(
+        Chat.tenant_id, db.func.count(Message.id)
+    ).join(Message).filter(Message.role == 'user').group_by(Chat.tenant_id).all())
     
-    for tenant in tenants:
-        users_count = User.query.filter_by(tenant_id=tenant.id).count()
-        questions_count = db.session.query(Message).join(Chat).filter(
-            Chat.tenant_id == tenant.id,
-            Message.role == 'user'
-        ).count()
+    def generate():
+        # Rij voor rij naar de client; de buffer bevat steeds maar één regel
+        output = StringIO()
+        writer = csv.writer(output)
+        
+        def flush():
+            row = output.getvalue()
+            output.seek(0)
+            output.truncate(0)
+            return row
         
-        mrr = mrr_prices.get(tenant.subscription_tier, 0) if tenant.subscription_status == 'active' else 0
+        writer.writerow(['Tenant ID', 'Company Name', 'Subdomain', 'Status', 'Tier', 'MRR', 'Users', 'Questions', 'Created At'])
+        yield flush()
         
-        writer.writerow([
-            tenant.id,
-            tenant.company_name,
-            tenant.subdomain,
-            tenant.subscription_status,
-            tenant.subscription_tier,
-            mrr,
-            users_count,
-            questions_count,
-            tenant.created_at.strftime('%Y-%m-%d %H:%M:%S')
-        ])
-    
-    output.seek(0)
+        for tenant in tenants:
+            mrr = MRR_PRICES.get(tenant.subscription_tier, 0) if tenant.subscription_status == 'active' else 0
+            
+            writer.writerow([
+                tenant.id,
+                tenant.company_name,
+                tenant.subdomain,
+                tenant.subscription_status,
+                tenant.subscription_tier,
+                mrr,
+                user_counts.get(tenant.id, 0),
+                question_counts.get(tenant.id, 0),
+                tenant.created_at.strftime('%Y-%m-%d %H:%M:%S')
+            ])
+            yield flush()
     
     return Response(
-        output.getvalue(),
+        stream_with_context(generate()),
         mimetype='text/csv',
         headers={'Content-Disposition': 'attachment; filename=analytics_export.csv'}
     )
@@ -3824,45 +4315,36 @@ def super_admin_analytics_export():
 @super_admin_required
 def super_admin_analytics():
     from dateutil.relativedelta import relativedelta
-    from datetime import datetime, timedelta
-    
-    tenants = Tenant.query.all()
-    all_users = User.query.all()
-    
-    mrr_prices = {'starter': 499, 'professional': 599, 'enterprise': 1199}
     
-    current_mrr = sum(mrr_prices.get(t.subscription_tier, 0) for t in tenants if t.subscription_status == 'active')
+    stats = get_tenant_revenue_stats()
+    current_mrr = stats['current_mrr']
     total_revenue = current_mrr * 12
     
-    active_tenants = sum(1 for t in tenants if t.subscription_status == 'active')
-    trial_tenants = sum(1 for t in tenants if t.subscription_status == 'trial')
-    
-    last_month = datetime.utcnow() - relativedelta(months=1)
-    last_month_tenants = [t for t in tenants if t.created_at < last_month and t.subscription_status == 'active']
-    last_month_mrr = sum(mrr_prices.get(t.subscription_tier, 0) for t in last_month_tenants)
-    
-    growth_rate = 0
-    if last_month_mrr > 0:
-        growth_rate = ((current_mrr - last_month_mrr) / last_month_mrr) * 100
-    elif current_mrr > 0 and last_month_mrr == 0:
-        growth_rate = 100
+    active_tenants = stats['active_tenants']
+    trial_tenants = stats['trial_tenants']
+    growth_rate = stats['growth_rate']
     
     total_questions = db.session.query(Message).filter(Message.role == 'user').count()
     
+    # Vragen per maand over dezelfde 12 volle maanden als de MRR-historie, in één GROUP BY
+    first_month_date, last_month_date = stats['mrr_history'][0][0], stats['mrr_history'][-1][0]
+    first_month_start = first_month_date.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    current_month_start = (last_month_date + relativedelta(months=1)).replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    year_col = db.extract('year', Message.created_at)
+    month_col = db.extract('month', Message.created_at)
+    questions_per_month = {
+        (int(year), int(month)): count
+        for year, month, count in db.session.query(year_col, month_col, db.func.count(Message.id)).filter(
+            Message.role == 'user',
+            Message.created_at >= first_month_start,
+            Message.created_at < current_month_start
+        ).group_by(year_col, month_col)
+    }
+    
     mrr_history = []
     questions_history = []
-    for i in range(12, 0, -1):
-        month_date = datetime.utcnow() - relativedelta(months=i)
-        month_tenants = [t for t in tenants if t.created_at <= month_date and t.subscription_status == 'active']
-        month_mrr = sum(mrr_prices.get(t.subscription_tier, 0) for t in month_tenants)
-        
-        month_start = month_date.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
-        month_end = (month_start + relativedelta(months=1)) - timedelta(seconds=1)
-        month_questions = db.session.query(Message).filter(
-            Message.role == 'user',
-            Message.created_at >= month_start,
-            Message.created_at <= month_end
-        ).count()
+    for month_date, month_mrr in stats['mrr_history']:
+        month_questions = questions_per_month.get((month_date.year, month_date.month), 0)
         
         mrr_history.append({
             'month': month_date.strftime('%b %Y'),
@@ -3873,25 +4355,17 @@ def super_admin_analytics():
             'count': month_questions
         })
     
-    tier_distribution = {
-        'starter': sum(1 for t in tenants if t.subscription_tier == 'starter' and t.subscription_status == 'active'),
-        'professional': sum(1 for t in tenants if t.subscription_tier == 'professional' and t.subscription_status == 'active'),
-        'enterprise': sum(1 for t in tenants if t.subscription_tier == 'enterprise' and t.subscription_status == 'active'),
-        'trial': sum(1 for t in tenants if t.subscription_tier == 'trial')
-    }
+    tier_distribution = dict(stats['active_per_tier'], trial=stats['trial_tier_tenants'])
     
-    top_tenants = []
-    for tenant in tenants:
-        tenant_questions = db.session.query(Message).join(Chat).filter(
-            Chat.tenant_id == tenant.id,
-            Message.role == 'user'
-        ).count()
-        if tenant_questions > 0:
-            top_tenants.append({
-                'tenant': tenant,
-                'questions': tenant_questions
-            })
-    top_tenants = sorted(top_tenants, key=lambda x: x['questions'], reverse=True)[:10]
+    # Top 10 tenants op aantal vragen: gegroepeerd, gesorteerd en gelimiteerd in de database
+    top_tenants = [{
+        'tenant': tenant,
+        'questions': questions
+    } for tenant, questions in db.session.query(
+        Tenant, db.func.count(Message.id).label('questions')
+    ).join(Chat, Chat.tenant_id == Tenant.id).join(Message, Message.chat_id == Chat.id).filter(
+        Message.role == 'user'
+    ).group_by(Tenant.id).order_by(db.desc('questions')).limit(10)]
     
     top_questions = db.session.query(
         Message.content,
@@ -3903,10 +4377,10 @@ def super_admin_analytics():
     recent_activity = db.session.query(Chat).order_by(Chat.updated_at.desc()).limit(20).all()
     
     conversion_funnel = {
-        'signups': len(tenants),
+        'signups': stats['total_tenants'],
         'trials': trial_tenants,
         'active': active_tenants,
-        'conversion_rate': (active_tenants / len(tenants) * 100) if tenants else 0
+        'conversion_rate': (active_tenants / stats['total_tenants'] * 100) if stats['total_tenants'] else 0
     }
     
     return render_template('super_admin_analytics.html',
@@ -4020,7 +4494,7 @@ def init_db():
             db.create_all()
             print("Database tables checked/created successfully")
             
-            if not SuperAdmin.query.first():
+            if not db.session.query(SuperAdmin.query.exists()).scalar():
                 # SECURITY: Generate strong random password for super admin (never hardcode!)
                 import secrets
                 import string
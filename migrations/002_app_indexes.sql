@@ -0,0 +1,12 @@
+-- Composite indexes for the tenant-scoped app queries (also declared in models.py
+-- for fresh databases created by db.create_all()).
+-- CONCURRENTLY: run outside a transaction, e.g. psql "$DATABASE_URL" -f 002_app_indexes.sql
+
+-- chat sidebar / /api/chats: WHERE tenant_id AND user_id ORDER BY updated_at DESC
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_chats_tenant_user_updated ON chats(tenant_id, user_id, updated_at DESC);
+
+-- login: WHERE email = ... (unique_tenant_email leads with tenant_id and cannot serve this)
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_users_email ON users(email);
+
+-- legacy messages table: WHERE tenant_id AND chat_id
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_messages_tenant_chat ON messages(tenant_id, chat_id);
@@ -0,0 +1,9 @@
+-- Indexes for the admin dashboard counters and the per-chat artifact lookups
+-- (also declared in models.py for fresh databases created by db.create_all()).
+-- CONCURRENTLY: run outside a transaction, e.g. psql "$DATABASE_URL" -f 003_dashboard_indexes.sql
+
+-- admin dashboard: WHERE tenant_id AND role = 'user' [AND created_at >= ...]
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_messages_tenant_role_created ON messages(tenant_id, role, created_at);
+
+-- get_chat / delete_chat / send_message: WHERE chat_id [AND message_id]
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_artifacts_chat_message ON artifacts(chat_id, message_id);
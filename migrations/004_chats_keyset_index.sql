@@ -0,0 +1,9 @@
+-- Chat sidebar keyset pagination orders by (updated_at DESC, id DESC); extend the
+-- chats index with id so the tie-breaker comes from the index as well
+-- (also declared in models.py for fresh databases created by db.create_all()).
+-- CONCURRENTLY: run outside a transaction, e.g. psql "$DATABASE_URL" -f 004_chats_keyset_index.sql
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_chats_tenant_user_updated_id ON chats(tenant_id, user_id, updated_at DESC, id DESC);
+
+-- superseded by idx_chats_tenant_user_updated_id (from 002_app_indexes.sql)
+DROP INDEX CONCURRENTLY IF EXISTS idx_chats_tenant_user_updated;
@@ -0,0 +1,7 @@
+-- Attachment lookups per chat (also declared in models.py for fresh databases
+-- created by db.create_all()). The chats and artifacts hot paths are already
+-- covered by 003_dashboard_indexes.sql and 004_chats_keyset_index.sql.
+-- CONCURRENTLY: run outside a transaction, e.g. psql "$DATABASE_URL" -f 005_uploaded_files_index.sql
+
+-- send_message / get_chat: WHERE chat_id AND tenant_id AND user_id; delete_chat: WHERE chat_id
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_uploaded_files_chat_tenant_user ON uploaded_files(chat_id, tenant_id, user_id);
@@ -0,0 +1,11 @@
+-- Tenant-wide chat activity (active users over the last 7/30 days) filters on
+-- tenant_id plus a date range without user_id, which idx_chats_tenant_user_updated_id
+-- cannot serve as a range scan (also declared in models.py for fresh databases
+-- created by db.create_all()).
+-- CONCURRENTLY: run outside a transaction, e.g. psql "$DATABASE_URL" -f 006_chats_tenant_activity_indexes.sql
+
+-- admin dashboard: WHERE tenant_id AND updated_at >= :since
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_chats_tenant_updated ON chats(tenant_id, updated_at);
+
+-- super admin tenant detail: WHERE tenant_id AND created_at >= :since
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_chats_tenant_created ON chats(tenant_id, created_at);
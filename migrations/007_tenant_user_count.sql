@@ -0,0 +1,10 @@
+-- Denormalized users-per-tenant counter (also declared in models.py for fresh
+-- databases created by db.create_all()). admin_users reserves a seat with
+-- UPDATE tenants SET user_count = user_count + 1 WHERE id AND user_count < max_users,
+-- so the max_users check and the increment are one atomic statement.
+-- Run once, e.g. psql "$DATABASE_URL" -f 007_tenant_user_count.sql
+
+ALTER TABLE tenants ADD COLUMN IF NOT EXISTS user_count INTEGER NOT NULL DEFAULT 0;
+
+-- backfill from the current users table
+UPDATE tenants t SET user_count = (SELECT count(*) FROM users u WHERE u.tenant_id = t.id);
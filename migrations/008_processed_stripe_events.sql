@@ -0,0 +1,11 @@
+-- Stripe webhook events that were handled successfully (also declared in models.py
+-- for fresh databases created by db.create_all()). stripe_webhook skips retried
+-- deliveries of these; a table instead of the per-worker cache so the check holds
+-- across all gunicorn workers.
+-- Run once, e.g. psql "$DATABASE_URL" -f 008_processed_stripe_events.sql
+
+CREATE TABLE IF NOT EXISTS processed_stripe_events (
+    event_id VARCHAR(255) PRIMARY KEY,
+    event_type VARCHAR(100) NOT NULL,
+    processed_at TIMESTAMP DEFAULT now()
+);
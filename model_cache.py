@@ -0,0 +1,159 @@
+"""
+Tenant / user lookup cache
+
+load_tenant and load_user run on every request while tenants and users
+change rarely. With Redis configured (REDIS_URL) their column values are
+cached in cache_service and re-attached to the current db.session without a
+SELECT, so routes can keep reading and modifying g.tenant and current_user as
+normal persistent objects. Without Redis the lookups go straight to the
+database: an in-process cache can't be invalidated across gunicorn workers.
+
+Cache entries are invalidated automatically after a commit that updated or
+deleted a Tenant or User through the ORM (mapper events), so routes don't
+need to remember to bust the cache. The same goes for TENANT_STATS_KEY, the
+cached revenue aggregates of the super admin pages, on any tenant change.
+"""
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session, make_transient_to_detached, object_session
+
+from models import db, Tenant, User
+from services import cache_service
+
+MODEL_CACHE_TTL = 300  # seconds
+
+# Revenue/tier aggregates over all tenants (super admin dashboard + analytics);
+# dropped together with the tenant entries whenever a tenant row changes
+TENANT_STATS_KEY = "lexi:tenants:stats:v1"
+
+# Secrets stay out of the cache; they are loaded from the database on access
+UNCACHED_COLUMNS = {
+    User: frozenset({'password_hash', 'session_token', 'reset_token', 'reset_token_expires_at'}),
+}
+
+
+def _id_key(model, obj_id):
+    return f"lexi:{model.__tablename__}:id:{obj_id}"
+
+
+def _subdomain_key(subdomain):
+    return f"lexi:tenants:sub:{subdomain}"
+
+
+def _to_dict(obj):
+    model = type(obj)
+    skip = UNCACHED_COLUMNS.get(model, ())
+    return {attr.key: getattr(obj, attr.key)
+            for attr in inspect(model).column_attrs if attr.key not in skip}
+
+
+def _from_dict(model, data):
+    """Rebuild a persistent instance in the current session without querying"""
+    obj = model(**data)
+    make_transient_to_detached(obj)
+    return db.session.merge(obj, load=False)
+
+
+def _get_by_id(model, obj_id):
+    if not obj_id:
+        return None
+    if not cache_service.enabled:
+        # In-process cache is per gunicorn worker and invalidation only reaches the
+        # worker that committed: without Redis every worker reads the database
+        return db.session.get(model, obj_id)
+
+    data = cache_service.get(_id_key(model, obj_id))
+    if data is not None:
+        return _from_dict(model, data)
+
+    obj = db.session.get(model, obj_id)
+    if obj:
+        cache_service.set(_id_key(model, obj_id), _to_dict(obj), MODEL_CACHE_TTL)
+    return obj
+
+
+def get_tenant_by_id(tenant_id):
+    """Tenant by primary key, cached for MODEL_CACHE_TTL seconds (Redis only)"""
+    return _get_by_id(Tenant, tenant_id)
+
+
+def get_user_by_id(user_id):
+    """User by primary key, cached for MODEL_CACHE_TTL seconds (Redis only)"""
+    return _get_by_id(User, user_id)
+
+
+def get_tenant_by_subdomain(subdomain):
+    """Tenant by subdomain, cached as subdomain -> id on top of get_tenant_by_id (Redis only)"""
+    if not subdomain:
+        return None
+    if not cache_service.enabled:
+        return Tenant.query.filter_by(subdomain=subdomain).first()
+
+    tenant_id = cache_service.get(_subdomain_key(subdomain))
+    if tenant_id is not None:
+        return get_tenant_by_id(tenant_id)
+
+    tenant = Tenant.query.filter_by(subdomain=subdomain).first()
+    if tenant:
+        cache_service.set(_subdomain_key(subdomain), tenant.id, MODEL_CACHE_TTL)
+        cache_service.set(_id_key(Tenant, tenant.id), _to_dict(tenant), MODEL_CACHE_TTL)
+    return tenant
+
+
+def invalidate_tenant(tenant_id, *subdomains):
+    """Drop cached entries for a tenant (and its old/new subdomains)"""
+    keys = [_id_key(Tenant, tenant_id)] + [_subdomain_key(s) for s in subdomains if s]
+    cache_service.delete(*keys)
+
+
+def invalidate_user(user_id):
+    """Drop the cached entry for a user"""
+    cache_service.delete(_id_key(User, user_id))
+
+
+def _pending_keys(target):
+    session = object_session(target)
+    if session is None:
+        return None
+    return session.info.setdefault('model_cache_invalidate', set())
+
+
+@event.listens_for(Tenant, 'after_update')
+@event.listens_for(Tenant, 'after_delete')
+def _collect_changed_tenant(mapper, connection, target):
+    # Remember which entries to drop; they are deleted after the commit so a
+    # concurrent request can't re-cache the not yet committed old row
+    keys = _pending_keys(target)
+    if keys is None:
+        return
+    subdomains = {target.subdomain}
+    subdomains.update(inspect(target).attrs.subdomain.history.deleted or ())
+    keys.add(_id_key(Tenant, target.id))
+    keys.update(_subdomain_key(s) for s in subdomains if s)
+    keys.add(TENANT_STATS_KEY)
+
+
+@event.listens_for(Tenant, 'after_insert')
+def _collect_new_tenant(mapper, connection, target):
+    keys = _pending_keys(target)
+    if keys is not None:
+        keys.add(TENANT_STATS_KEY)
+
+
+@event.listens_for(User, 'after_update')
+@event.listens_for(User, 'after_delete')
+def _collect_changed_user(mapper, connection, target):
+    keys = _pending_keys(target)
+    if keys is not None:
+        keys.add(_id_key(User, target.id))
+
+
+@event.listens_for(Session, 'after_commit')
+def _invalidate_changed(session):
+    keys = session.info.pop('model_cache_invalidate', None)
+    if keys:
+        cache_service.delete(*keys)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_changed(session):
+    session.info.pop('model_cache_invalidate', None)
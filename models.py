@@ -36,6 +36,10 @@ class SuperAdmin(db.Model, UserMixin):
     name = db.Column(db.String(255), nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     
+    def get_id(self):
+        # Prefix zodat load_user zonder extra query weet dat dit een SuperAdmin is
+        return f"sa:{self.id}"
+    
     def set_password(self, password):
         self.password_hash = generate_password_hash(password)
     
@@ -53,6 +57,7 @@ class Tenant(db.Model):
     status = db.Column(db.String(50), default='trial')
     trial_ends_at = db.Column(db.DateTime, default=lambda: datetime.utcnow() + timedelta(days=14))
     max_users = db.Column(db.Integer, default=5)
+    user_count = db.Column(db.Integer, default=0, server_default='0', nullable=False)  # bijgehouden bij toevoegen/verwijderen van users
     subscription_tier = db.Column(db.String(50), default='trial')
     subscription_status = db.Column(db.String(50), default='trial')
     mrr = db.Column(db.Float, default=0.0)
@@ -95,7 +100,10 @@ class User(db.Model, UserMixin):
     chats = db.relationship('Chat', backref='user', lazy=True, cascade='all, delete-orphan')
     support_tickets = db.relationship('SupportTicket', backref='user', lazy=True, cascade='all, delete-orphan')
     
-    __table_args__ = (db.UniqueConstraint('tenant_id', 'email', name='unique_tenant_email'),)
+    __table_args__ = (
+        db.UniqueConstraint('tenant_id', 'email', name='unique_tenant_email'),
+        db.Index('idx_users_email', 'email'),  # login zoekt op email over alle tenants
+    )
     
     def set_password(self, password):
         self.password_hash = generate_password_hash(password)
@@ -120,6 +128,12 @@ class Chat(db.Model):
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     
     messages = db.relationship('Message', backref='chat', lazy=True, cascade='all, delete-orphan', order_by='Message.created_at')
+    
+    __table_args__ = (
+        db.Index('idx_chats_tenant_user_updated_id', tenant_id, user_id, updated_at.desc(), id.desc()),
+        db.Index('idx_chats_tenant_updated', 'tenant_id', 'updated_at'),  # actieve gebruikers per tenant
+        db.Index('idx_chats_tenant_created', 'tenant_id', 'created_at'),
+    )
 
 class Message(db.Model):
     __tablename__ = 'messages'
@@ -132,6 +146,11 @@ class Message(db.Model):
     feedback_rating = db.Column(db.Integer, nullable=True)
     feedback_comment = db.Column(db.Text, nullable=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    __table_args__ = (
+        db.Index('idx_messages_tenant_chat', 'tenant_id', 'chat_id'),
+        db.Index('idx_messages_tenant_role_created', 'tenant_id', 'role', 'created_at'),
+    )
 
 class Subscription(db.Model):
     __tablename__ = 'subscriptions'
@@ -147,6 +166,14 @@ class Subscription(db.Model):
     current_period_end = db.Column(db.DateTime, nullable=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
+class ProcessedStripeEvent(db.Model):
+    """Stripe webhook events that were handled successfully (retries of these are skipped)"""
+    __tablename__ = 'processed_stripe_events'
+    
+    event_id = db.Column(db.String(255), primary_key=True)
+    event_type = db.Column(db.String(100), nullable=False)
+    processed_at = db.Column(db.DateTime, default=datetime.utcnow)
+
 class Template(db.Model):
     __tablename__ = 'templates'
     
@@ -173,6 +200,11 @@ class UploadedFile(db.Model):
     mime_type = db.Column(db.String(100), nullable=True)
     extracted_text = db.Column(db.Text, nullable=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    __table_args__ = (
+        # send_message / get_chat: WHERE chat_id AND tenant_id AND user_id; delete_chat: WHERE chat_id
+        db.Index('idx_uploaded_files_chat_tenant_user', 'chat_id', 'tenant_id', 'user_id'),
+    )
 
 class Artifact(db.Model):
     __tablename__ = 'artifacts'
@@ -187,6 +219,11 @@ class Artifact(db.Model):
     s3_key = db.Column(db.String(500), nullable=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
+    __table_args__ = (
+        # message_id holds the position in the S3 transcript; lookups go per chat
+        db.Index('idx_artifacts_chat_message', 'chat_id', 'message_id'),
+    )
+
 class SupportTicket(db.Model):
     __tablename__ = 'support_tickets'
     
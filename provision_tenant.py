@@ -11,14 +11,16 @@ except ImportError:
 import re
 
 
+TIER_MAX_USERS = {
+    'starter': 5,
+    'professional': 20,
+    'enterprise': 999999
+}
+
+
 def get_max_users_for_tier(tier):
     """Get maximum users allowed for subscription tier"""
-    tier_limits = {
-        'starter': 5,
-        'professional': 20,
-        'enterprise': 999999
-    }
-    return tier_limits.get(tier, 5)
+    return TIER_MAX_USERS.get(tier, 5)
 
 
 def provision_tenant_from_signup(pending_signup, stripe_session_data=None):
@@ -65,9 +67,14 @@ def provision_tenant_from_signup(pending_signup, stripe_session_data=None):
         base_subdomain = re.sub(r'[^a-z0-9]', '', company_name.lower().replace(' ', ''))[:20]
         subdomain = base_subdomain if base_subdomain else 'tenant'
         
-        counter = 1
+        # All taken subdomains with this prefix in one query, then pick the first
+        # free suffix locally (the prefix is [a-z0-9] only, so no LIKE escaping)
         original_subdomain = subdomain
-        while Tenant.query.filter_by(subdomain=subdomain).first():
+        taken = {s for (s,) in db.session.query(Tenant.subdomain).filter(
+            Tenant.subdomain.like(f"{original_subdomain}%")
+        )}
+        counter = 1
+        while subdomain in taken:
             subdomain = f"{original_subdomain}{counter}"
             counter += 1
         
@@ -80,6 +87,7 @@ def provision_tenant_from_signup(pending_signup, stripe_session_data=None):
             status='active',
             subscription_tier=tier,
             max_users=get_max_users_for_tier(tier),
+            user_count=1,  # the admin user created below
             cao_preference=cao_preference
         )
         db.session.add(tenant)
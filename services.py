@@ -7,9 +7,12 @@ from datetime import datetime
 from werkzeug.utils import secure_filename
 import uuid
 import io
+import time
+import pickle
 from PyPDF2 import PdfReader
 from docx import Document
 import threading
+from concurrent.futures import ThreadPoolExecutor
 
 # Load environment variables from .env file
 # Always use manual loading to ensure environment variables are set in subprocess context
@@ -52,6 +55,7 @@ class MemgraphDeepSeekService:
     """
     _instance = None
     _lock = threading.Lock()
+    STREAM_ERROR_MESSAGE = "Er ging iets mis bij het verwerken van je vraag. Probeer het opnieuw."
 
     def __new__(cls):
         """Thread-safe singleton implementation"""
@@ -201,8 +205,31 @@ Gebruik alle beschikbare documenten optimaal. Je bent expert-niveau - vertrouw o
         Returns:
             str: AI response
         """
+        chunks = []
+        try:
+            for delta in self.chat_stream(message, conversation_history, system_instruction):
+                chunks.append(delta)
+        except Exception:
+            # Stream broke off after partial content: answer with the error only
+            return self.STREAM_ERROR_MESSAGE
+        return "".join(chunks)
+
+    def chat_stream(self, message, conversation_history=None, system_instruction=None):
+        """
+        Same as chat(), but yields the response in pieces as DeepSeek streams them
+
+        Yields:
+            str: Response text deltas. Errors before any content are yielded
+            as text; once content was yielded the exception is re-raised, so
+            the error isn't glued onto the partial answer.
+        """
         if not self.enabled:
-            return "Lexi is momenteel niet beschikbaar. Controleer de Memgraph en DeepSeek configuratie."
+            yield "Lexi is momenteel niet beschikbaar. Controleer de Memgraph en DeepSeek configuratie."
+            return
+
+        import httpx
+
+        has_content = False
 
         try:
             # 1. Generate embedding for user query (Voyage AI preferred)
@@ -325,10 +352,6 @@ Gebruik alle beschikbare documenten optimaal. Je bent expert-niveau - vertrouw o
             })
 
             # 5. Call DeepSeek API with streaming
-            import httpx
-
-            full_response = ""
-
             with httpx.stream(
                 'POST',
                 self.deepseek_api_url,
@@ -363,21 +386,25 @@ Gebruik alle beschikbare documenten optimaal. Je bent expert-niveau - vertrouw o
                                 delta = chunk['choices'][0].get('delta', {})
                                 content = delta.get('content')
                                 if content:
-                                    full_response += content
+                                    has_content = True
+                                    yield content
                         except json.JSONDecodeError:
                             continue
 
-            return full_response if full_response else "Geen response ontvangen van AI."
+            if not has_content:
+                yield "Geen response ontvangen van AI."
 
         except httpx.HTTPStatusError as e:
             print(f"❌ DeepSeek API error: {e.response.status_code} - {e.response.text}")
-            return f"Er ging iets mis bij het verwerken van je vraag (API error: {e.response.status_code})."
+            yield f"Er ging iets mis bij het verwerken van je vraag (API error: {e.response.status_code})."
 
         except Exception as e:
             print(f"❌ Chat error: {e}")
             import traceback
             traceback.print_exc()
-            return "Er ging iets mis bij het verwerken van je vraag. Probeer het opnieuw."
+            if has_content:
+                raise
+            yield self.STREAM_ERROR_MESSAGE
 
 
 class DeepSeekR1Client:
@@ -729,6 +756,9 @@ class S3Service:
     """
     _instance = None
     _lock = threading.Lock()
+    URL_CACHE_MARGIN = 60  # reuse a URL only while it stays valid this many seconds
+    MAX_PRESIGN_EXPIRY = 7 * 24 * 3600  # SigV4 presigned URLs are valid for at most 7 days
+    MAX_URL_CACHE_ENTRIES = 10000
     
     def __new__(cls):
         """Thread-safe singleton implementation"""
@@ -746,6 +776,15 @@ class S3Service:
         if self._initialized:
             return
             
+        # Presigned GET URLs per (s3_key, expiration): signing is local, so a
+        # per-process dict is cheaper than a Redis round-trip
+        self._url_cache = {}
+        self._url_cache_lock = threading.Lock()
+        
+        # Presigned URL lifetimes; long enough that slow connections don't hit 403s mid-transfer
+        self.upload_url_expiry = self._presign_expiry('S3_PRESIGN_EXPIRY_UPLOAD', 3600)
+        self.download_url_expiry = self._presign_expiry('S3_PRESIGN_EXPIRY_DOWNLOAD', 3600)
+        
         self.endpoint = os.getenv('S3_ENDPOINT_URL')
         self.bucket = os.getenv('S3_BUCKET_NAME')
         self.access_key = os.getenv('S3_ACCESS_KEY')
@@ -771,6 +810,16 @@ class S3Service:
             self._initialized = True
             print("S3 Service disabled (missing credentials)")
     
+    @classmethod
+    def _presign_expiry(cls, env_name, default):
+        """Expiry in seconds from the environment, clamped to 1s..7 days"""
+        try:
+            seconds = int(os.getenv(env_name, default))
+        except ValueError:
+            print(f"⚠️  Invalid {env_name}, using {default}s")
+            seconds = default
+        return max(1, min(seconds, cls.MAX_PRESIGN_EXPIRY))
+    
     def upload_file(self, file, tenant_id, folder='uploads'):
         if not self.enabled:
             return None
@@ -792,6 +841,54 @@ class S3Service:
             print(f"S3 upload error: {e}")
             return None
     
+    def generate_upload_url(self, filename, content_type, content_length, tenant_id, folder='uploads', expiration=None):
+        """Presigned PUT for a direct browser upload (type and size are signed); returns (s3_key, url)"""
+        if not self.enabled:
+            return None, None
+        
+        expiration = expiration or self.upload_url_expiry
+        try:
+            unique_filename = f"{uuid.uuid4()}_{secure_filename(filename)}"
+            s3_key = f"{folder}/tenant_{tenant_id}/{unique_filename}"
+            
+            url = self.s3_client.generate_presigned_url(
+                'put_object',
+                Params={
+                    'Bucket': self.bucket,
+                    'Key': s3_key,
+                    'ContentType': content_type,
+                    'ContentLength': content_length
+                },
+                ExpiresIn=expiration
+            )
+            return s3_key, url
+        except Exception as e:
+            print(f"S3 presign upload error: {e}")
+            return None, None
+    
+    def get_file_size(self, s3_key):
+        """Object size in bytes, or None if the object does not exist"""
+        if not self.enabled:
+            return None
+        
+        try:
+            response = self.s3_client.head_object(Bucket=self.bucket, Key=s3_key)
+            return response['ContentLength']
+        except Exception as e:
+            print(f"S3 head error: {e}")
+            return None
+    
+    def download_file_bytes(self, s3_key):
+        if not self.enabled:
+            return None
+        
+        try:
+            response = self.s3_client.get_object(Bucket=self.bucket, Key=s3_key)
+            return response['Body'].read()
+        except Exception as e:
+            print(f"S3 download error: {e}")
+            return None
+    
     def upload_content(self, content, filename, tenant_id, folder='artifacts'):
         if not self.enabled:
             return None
@@ -878,20 +975,39 @@ class S3Service:
             print(f"S3 download error: {e}")
             return None, f"Fout bij downloaden: {str(e)}"
     
-    def get_file_url(self, s3_key, expiration=3600):
+    def get_file_url(self, s3_key, expiration=None):
+        """Presigned GET URL; reopening the same file reuses the URL until it nears expiry"""
         if not self.enabled:
             return None
         
+        expiration = expiration or self.download_url_expiry
+        cache_key = (s3_key, expiration)
+        now = time.monotonic()
+        with self._url_cache_lock:
+            entry = self._url_cache.get(cache_key)
+            if entry is not None and entry[0] > now:
+                return entry[1]
+        
         try:
             url = self.s3_client.generate_presigned_url(
                 'get_object',
                 Params={'Bucket': self.bucket, 'Key': s3_key},
                 ExpiresIn=expiration
             )
-            return url
         except Exception as e:
             print(f"S3 get URL error: {e}")
             return None
+        
+        reuse_for = expiration - self.URL_CACHE_MARGIN
+        if reuse_for > 0:
+            with self._url_cache_lock:
+                if len(self._url_cache) >= self.MAX_URL_CACHE_ENTRIES:
+                    self._url_cache = {k: v for k, v in self._url_cache.items() if v[0] > now}
+                    if len(self._url_cache) >= self.MAX_URL_CACHE_ENTRIES:
+                        # Still full: drop the oldest entry (dicts keep insertion order)
+                        del self._url_cache[next(iter(self._url_cache))]
+                self._url_cache[cache_key] = (now + reuse_for, url)
+        return url
     
     def delete_file(self, s3_key):
         if not self.enabled:
@@ -904,6 +1020,28 @@ class S3Service:
             print(f"S3 delete error: {e}")
             return False
     
+    def delete_files(self, s3_keys):
+        """Delete many objects with DeleteObjects (max 1000 keys per call); returns number deleted"""
+        if not self.enabled:
+            return 0
+        
+        keys = [k for k in s3_keys if k]
+        deleted = 0
+        for start in range(0, len(keys), 1000):
+            batch = keys[start:start + 1000]
+            try:
+                response = self.s3_client.delete_objects(
+                    Bucket=self.bucket,
+                    Delete={'Objects': [{'Key': k} for k in batch], 'Quiet': True}
+                )
+                errors = response.get('Errors', [])
+                for error in errors:
+                    print(f"S3 delete error: {error.get('Key')}: {error.get('Message')}")
+                deleted += len(batch) - len(errors)
+            except Exception as e:
+                print(f"S3 delete error: {e}")
+        return deleted
+    
     def save_chat_messages(self, chat_id, tenant_id, messages):
         """Save chat messages to S3 as JSON"""
         if not self.enabled:
@@ -941,6 +1079,28 @@ class S3Service:
             print(f"S3 get chat messages error: {e}")
             return []
     
+    def get_chat_messages_versioned(self, s3_key):
+        """get_chat_messages plus the object's ETag (None if unreadable), for append_chat_message(existing=...)"""
+        if not self.enabled:
+            return [], None
+
+        try:
+            response = self.s3_client.get_object(Bucket=self.bucket, Key=s3_key)
+            content = response['Body'].read().decode('utf-8')
+            return json.loads(content), response.get('ETag')
+        except self.s3_client.exceptions.NoSuchKey:
+            return [], None
+        except Exception as e:
+            print(f"S3 get chat messages error: {e}")
+            return [], None
+
+    def _get_etag(self, s3_key):
+        """Current ETag of an object, or None"""
+        try:
+            return self.s3_client.head_object(Bucket=self.bucket, Key=s3_key).get('ETag')
+        except Exception:
+            return None
+
     def get_messages(self, s3_key):
         """Get chat messages from S3 wrapped in messages dict"""
         if not self.enabled:
@@ -957,14 +1117,27 @@ class S3Service:
             print(f"S3 get messages error: {e}")
             return {'messages': []}
     
-    def append_chat_message(self, s3_key, chat_id, tenant_id, message):
-        """Append a new message to existing chat in S3"""
+    def append_chat_message(self, s3_key, chat_id, tenant_id, message, existing=None):
+        """Append a new message (or a list of messages, in one GET+PUT) to existing chat in S3
+
+        existing: (messages, etag) from get_chat_messages_versioned, fetched
+        earlier (e.g. during the AI call). Right before the PUT a HEAD checks
+        the ETag; if the transcript changed meanwhile it is read again, so a
+        message written by another request is not overwritten. That HEAD is
+        one S3 round-trip on the write path: the prefetch saves the GET (and
+        its growing body) but not the round-trip. A conditional PUT (IfMatch)
+        would drop it, but needs boto3 >= 1.35 and an S3 backend that
+        supports conditional writes.
+        """
         if not self.enabled:
             return False
         
         try:
-            messages = self.get_chat_messages(s3_key) if s3_key else []
-            messages.append(message)
+            if existing is not None and existing[1] and self._get_etag(s3_key) == existing[1]:
+                messages = list(existing[0])
+            else:
+                messages = self.get_chat_messages(s3_key) if s3_key else []
+            messages.extend(message if isinstance(message, list) else [message])
             
             new_s3_key = self.save_chat_messages(chat_id, tenant_id, messages)
             return new_s3_key
@@ -972,6 +1145,114 @@ class S3Service:
             print(f"S3 append chat message error: {e}")
             return None
 
+class CacheService:
+    """
+    Singleton Cache Service
+
+    - Redis when REDIS_URL is set and the redis package is installed:
+      shared by all gunicorn workers (also used for Flask-Session)
+    - Otherwise a small in-process TTL cache per worker
+    """
+    _instance = None
+    _lock = threading.Lock()
+    MAX_LOCAL_ENTRIES = 10000
+
+    def __new__(cls):
+        """Thread-safe singleton implementation"""
+        if cls._instance is None:
+            with cls._lock:
+                # Double-check locking pattern
+                if cls._instance is None:
+                    cls._instance = super().__new__(cls)
+                    cls._instance._initialized = False
+        return cls._instance
+
+    def __init__(self):
+        """Initialize only once per process (singleton pattern)"""
+        # Skip if already initialized
+        if self._initialized:
+            return
+
+        self.redis = None
+        self.enabled = False  # True = Redis (shared), False = in-process fallback
+        self._local = {}
+        self._local_lock = threading.Lock()
+
+        redis_url = os.getenv('REDIS_URL')
+        if redis_url:
+            try:
+                import redis
+                # redis:// or unix:///path/redis.sock; the connection pool is fork-safe
+                self.redis = redis.Redis.from_url(
+                    redis_url,
+                    socket_keepalive=True,
+                    socket_timeout=2,
+                    health_check_interval=30
+                )
+                self.redis.ping()
+                self.enabled = True
+                print("✓ Cache Service initialized with Redis (singleton)")
+            except Exception as e:
+                print(f"⚠️  Redis not available ({e}) - using in-process cache")
+                self.redis = None
+        else:
+            print("Cache Service using in-process cache (REDIS_URL not set)")
+
+        self._initialized = True
+
+    def get(self, key):
+        """Return cached value or None"""
+        if self.redis is not None:
+            try:
+                raw = self.redis.get(key)
+                return pickle.loads(raw) if raw is not None else None
+            except Exception as e:
+                print(f"Cache get error: {e}")
+                return None
+
+        with self._local_lock:
+            entry = self._local.get(key)
+            if entry is None:
+                return None
+            if entry[0] < time.monotonic():
+                del self._local[key]
+                return None
+            return entry[1]
+
+    def set(self, key, value, ttl=300):
+        """Cache value for ttl seconds"""
+        if self.redis is not None:
+            try:
+                self.redis.setex(key, ttl, pickle.dumps(value))
+            except Exception as e:
+                print(f"Cache set error: {e}")
+            return
+
+        with self._local_lock:
+            if len(self._local) >= self.MAX_LOCAL_ENTRIES:
+                now = time.monotonic()
+                for stale_key in [k for k, (expires, _) in self._local.items() if expires < now]:
+                    del self._local[stale_key]
+                if len(self._local) >= self.MAX_LOCAL_ENTRIES:
+                    # Still full: drop the oldest entry (dicts keep insertion order)
+                    del self._local[next(iter(self._local))]
+            self._local[key] = (time.monotonic() + ttl, value)
+
+    def delete(self, *keys):
+        """Invalidate one or more keys"""
+        if not keys:
+            return
+        if self.redis is not None:
+            try:
+                self.redis.delete(*keys)
+            except Exception as e:
+                print(f"Cache delete error: {e}")
+            return
+
+        with self._local_lock:
+            for key in keys:
+                self._local.pop(key, None)
+
 class StripeService:
     @staticmethod
     def create_checkout_session(tenant_id, plan, success_url, cancel_url):
@@ -1021,7 +1302,10 @@ class EmailService:
     - Uses thread-safe singleton pattern for consistency
     - Prevents multiple MailerSend API initializations
     - Ensures single email service instance across all requests
+    - Sends in the background (send_email queues, see _deliver_email)
     """
+    MAX_SEND_ATTEMPTS = 3
+    
     _instance = None
     _lock = threading.Lock()
     
@@ -1050,6 +1334,9 @@ class EmailService:
         # TEST_EMAIL_OVERRIDE: Route all emails to this address for layout testing
         self.test_email_override = os.getenv('TEST_EMAIL_OVERRIDE', '')
         
+        # Background delivery; threads start lazily on the first email (after the gunicorn fork)
+        self._executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='email')
+        
         self._initialized = True
         
         if self.enabled:
@@ -1058,7 +1345,13 @@ class EmailService:
                 print(f"⚠️  TEST MODE: All emails redirected to {self.test_email_override}")
     
     def send_email(self, to_email, subject, html_content):
-        """Send email via MailerSend HTTP API (stable, production-ready)"""
+        """
+        Queue an email for delivery via the MailerSend HTTP API
+
+        Delivery runs on a background thread so request handlers (signup,
+        webhooks, user management) don't wait for MailerSend. Returns True
+        when the email was queued.
+        """
         if not self.enabled:
             print(f"Email not sent (MailerSend not configured): {subject} to {to_email}")
             return False
@@ -1069,6 +1362,22 @@ class EmailService:
             to_email = self.test_email_override
             print(f"📧 TEST MODE: Redirecting email from {original_to_email} to {to_email}")
         
+        self._executor.submit(self._deliver_email, to_email, subject, html_content)
+        return True
+    
+    def _deliver_email(self, to_email, subject, html_content):
+        """Send one email, retrying transient failures (network, 429, 5xx)"""
+        for attempt in range(1, self.MAX_SEND_ATTEMPTS + 1):
+            sent, retryable = self._post_email(to_email, subject, html_content)
+            if sent or not retryable:
+                return sent
+            if attempt < self.MAX_SEND_ATTEMPTS:
+                time.sleep(2 ** attempt)
+        print(f"MailerSend: giving up on {to_email} (subject: {subject}) after {self.MAX_SEND_ATTEMPTS} attempts")
+        return False
+    
+    def _post_email(self, to_email, subject, html_content):
+        """Single MailerSend API call; returns (sent, retryable)"""
         try:
             # Strip HTML tags for plain text version
             import re
@@ -1106,16 +1415,16 @@ class EmailService:
             
             if response.status_code == 202:
                 print(f"✓ Email sent successfully to {to_email} (subject: {subject})")
-                return True
+                return True, False
             else:
                 print(f"MailerSend error: Status {response.status_code}, Response: {response.text}")
-                return False
+                return False, response.status_code == 429 or response.status_code >= 500
                 
         except Exception as e:
             print(f"MailerSend error: {e}")
             import traceback
             traceback.print_exc()
-            return False
+            return False, True
     
     def send_welcome_email(self, user, tenant, login_url):
         """Send welcome email after successful signup (branded template)"""
@@ -1961,3 +2270,4 @@ class EmailService:
 rag_service = MemgraphDeepSeekService()
 s3_service = S3Service()
 email_service = EmailService()
+cache_service = CacheService()